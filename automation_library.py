@@ -1,41 +1,471 @@
 import base64
+import bisect
+import heapq
+import csv
+import io
 import gspread
 import json
 import logging
 import os
-import pandas as pd
 import pytz
+import random
+import re
 import requests
-import sys
-
-from datetime import datetime, date
+import socket
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, timezone as dt_timezone
+from ipaddress import ip_address
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.mime.base import MIMEBase
-from email import encoders
+from email.utils import parsedate_to_datetime
+from fpdf import FPDF
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 from getpass import getpass
+from itertools import islice
+from tempfile import SpooledTemporaryFile
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+from google_auth_httplib2 import AuthorizedHttp
+from httplib2 import Http
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.exceptions import RefreshError as GoogleRefreshError
+from google.auth.transport.requests import Request as GoogleRequest
 from google.oauth2.credentials import Credentials
-from pandas import DataFrame
 from pydrive2.auth import GoogleAuth, RefreshError
 from pydrive2.drive import GoogleDrive
-from simple_salesforce import Salesforce
-from time import sleep
+from simple_salesforce import Salesforce, SalesforceExpiredSession
+from time import monotonic, sleep, time
+
+try:
+    import pandas as pd
+except ImportError:
+    # pandas is only needed for get_report's DataFrame
+    pd = None
+
+
+try:
+    import dns.resolver
+except ImportError:
+    # Without dnspython hostnames are looked up with socket and
+    # kept for HostResolver's default_ttl
+    dns = None
+
+
+# Remembers which account the current thread is working on, so log
+# lines from concurrent workers can be told apart
+_log_context = threading.local()
+
+
+class AccountLogFilter(logging.Filter):
+    def filter(self, record) -> bool:
+        record.account = getattr(_log_context, 'account', '-')
+        return True
+
+
+@contextmanager
+def log_account(account):
+    """
+    Tags every log line written by this thread with the
+    account being worked on until the block exits.
+    """
+    previous = getattr(_log_context, 'account', '-')
+    _log_context.account = account
+    try:
+        yield
+    finally:
+        _log_context.account = previous
 
 
 def get_logger(module, filename=None):
-    log_format = '%(asctime)s  %(name)8s  %(levelname)5s  %(message)s'
+    log_format = '%(asctime)s  %(name)8s  %(levelname)5s  [%(account)s]  %(message)s'
     logging.basicConfig(level=logging.INFO,
                         format=log_format,
                         filename=filename)
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, AccountLogFilter) for f in handler.filters):
+            handler.addFilter(AccountLogFilter())
     return logging.getLogger(module)
 
 
+def soql_quote(value) -> str:
+    # Escapes a value so it can sit between single quotes in SOQL
+    value = str(value).replace('\\', '\\\\').replace("'", "\\'")
+    return f"'{value}'"
+
+
+def drive_quote(value) -> str:
+    # Escapes a value so it can sit between single quotes in a Drive query
+    value = str(value).replace('\\', '\\\\').replace("'", "\\'")
+    return f"'{value}'"
+
+
+def chunks(items, size: int):
+    # Splits any iterable into lists of at most size items
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ReportRow:
+    """
+    One row of a report. Values are read by column label, like
+    row['Account Name']. The label-to-position mapping is shared
+    by every row of the report, so a row only holds its values.
+    """
+    __slots__ = ('columns', 'values')
+
+    def __init__(self, columns: dict, values: tuple) -> None:
+        self.columns = columns
+        self.values = values
+
+
+    def __getitem__(self, label):
+        return self.values[self.columns[label]]
+
+
+    def get(self, label, default=None):
+        index = self.columns.get(label)
+        return default if index is None else self.values[index]
+
+
+    def keys(self) -> list:
+        return list(self.columns)
+
+
+    def __repr__(self) -> str:
+        return f'ReportRow({dict(zip(self.columns, self.values))})'
+
+
+class ReportError(Exception):
+    def __init__(self, reason) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, reason) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RateLimiter:
+    """
+    Paces the calls to one backend (salesforce, calcom or google)
+    with a token bucket: at most `rate` calls a second and
+    `concurrency` at once. When the backend says slow down (429,
+    503, or Google's rate limit errors) the whole backend pauses
+    for its Retry-After, or a jittered backoff, and the rate and
+    concurrency are halved. They creep back up as calls succeed.
+
+    Only idempotent calls are sent again after a server error.
+    A POST or PATCH may already have been carried out, so it is
+    only retried on 429, or 503 with a Retry-After, which mean
+    it was turned away.
+
+    For SalesForce the Sforce-Limit-Info header is also read, so
+    check_api_budget() can stop new work before the org's daily
+    API allowance is used up.
+    """
+    retry_statuses = {429, 500, 502, 503, 504}
+    idempotent_methods = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    def __init__(self, name, rate=10, concurrency=8, retries=4, max_backoff=60) -> None:
+        self.logger = get_logger(module='RateLimiter')
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.retries = retries
+        self.max_backoff = max_backoff
+
+        self.tokens = float(concurrency)
+        self.updated = monotonic()
+        self.in_flight = 0
+        self.paused_until = 0
+        self.successes = 0
+        self.api_usage = None
+        self.condition = threading.Condition()
+
+
+    @contextmanager
+    def slot(self):
+        # Waits for a token and a free spot, then holds the spot
+        with self.condition:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.concurrency, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait_for = self.paused_until - now
+                elif self.in_flight >= self.concurrency:
+                    wait_for = None
+                elif self.tokens < 1:
+                    wait_for = (1 - self.tokens) / self.rate
+                else:
+                    break
+                self.condition.wait(wait_for)
+            self.tokens -= 1
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+
+    def call(self, send, method='GET') -> requests.Response:
+        """
+        Runs send() (a requests call) in a slot, sending it again
+        when the backend answers with a retryable status.
+        """
+        idempotent = method.upper() in self.idempotent_methods
+        for attempt in range(self.retries + 1):
+            with self.slot():
+                response = send()
+            self.read_limits(response.headers)
+
+            retry_after = response.headers.get('Retry-After')
+            retry = self.retryable(response.status_code, idempotent=idempotent, retry_after=retry_after)
+            if not retry or attempt == self.retries:
+                if response.status_code < 400:
+                    self.succeeded()
+                return response
+
+            self.throttled(self.backoff(attempt, retry_after))
+            response.close()
+
+
+    def run(self, function, idempotent=True):
+        """
+        Like call, for the Google clients, which raise an error
+        instead of returning the response. Pass idempotent=False
+        for calls that mustn't happen twice, like sending an email.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self.slot():
+                    result = function()
+            except Exception as error:
+                status, retry_after = self._error_status(error)
+                if not self.retryable(status, error, idempotent, retry_after) or attempt == self.retries:
+                    raise
+                self.throttled(self.backoff(attempt, retry_after))
+                continue
+
+            self.succeeded()
+            return result
+
+
+    def throttled(self, delay) -> None:
+        # Pauses the backend and halves how hard it is pushed
+        with self.condition:
+            self.paused_until = max(self.paused_until, monotonic() + delay)
+            self.concurrency = max(1, self.concurrency // 2)
+            self.rate = max(self.max_rate / 20, self.rate / 2)
+            self.successes = 0
+            self.condition.notify_all()
+        self.logger.warning(f'{self.name} is rate limiting. Waiting {delay:.1f} seconds, '
+                            f'then {self.concurrency} at a time.')
+
+
+    def succeeded(self) -> None:
+        # Every 20 good calls in a row win back some speed
+        with self.condition:
+            self.successes += 1
+            if self.successes >= 20:
+                self.successes = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.rate = min(self.max_rate, self.rate * 1.25)
+                self.condition.notify_all()
+
+
+    def backoff(self, attempt, retry_after=None) -> float:
+        # Retry-After when the backend sent one, else a jittered exponential wait
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), self.max_backoff)
+            except ValueError:
+                pass
+            try:
+                seconds = (parsedate_to_datetime(retry_after) - datetime.now(dt_timezone.utc)).total_seconds()
+                return min(max(seconds, 0), self.max_backoff)
+            except (TypeError, ValueError):
+                pass
+        return random.uniform(0.5, min(self.max_backoff, 2 ** (attempt + 1)))
+
+
+    def read_limits(self, headers) -> None:
+        # Sforce-Limit-Info: api-usage=18/5000
+        match = re.search(r'api-usage=(\d+)/(\d+)', headers.get('Sforce-Limit-Info', ''))
+        if match:
+            self.api_usage = (int(match.group(1)), int(match.group(2)))
+
+
+    def over_budget(self, reserve) -> bool:
+        # True once all but `reserve` (a fraction) of the daily allowance is used
+        if not self.api_usage:
+            return False
+        used, limit = self.api_usage
+        return used >= limit * (1 - reserve)
+
+
+    def retryable(self, status, error=None, idempotent=True, retry_after=None) -> bool:
+        # Google says rate limits with a 403 too
+        if status == 429 or (status == 403 and 'ateLimitExceeded' in str(error)):
+            return True
+        if idempotent:
+            return status in self.retry_statuses
+        return status == 503 and bool(retry_after)
+
+
+    @staticmethod
+    def _error_status(error):
+        # (status, Retry-After) from a googleapiclient, PyDrive2 or gspread error
+        if not isinstance(error, HttpError) and error.args and isinstance(error.args[0], HttpError):
+            error = error.args[0]
+        if isinstance(error, HttpError):
+            return error.resp.status, error.resp.get('retry-after')
+        response = getattr(error, 'response', None)
+        if response is not None and hasattr(response, 'status_code'):
+            return response.status_code, response.headers.get('Retry-After')
+        # Connection problems get retried like a 503
+        if isinstance(error, (OSError, TimeoutError)):
+            return 503, None
+        return None, None
+
+
+# Requests per second and calls at once for each backend. Override
+# them with 'rate_limits' in config.json, e.g.
+# {"calcom": {"rate": 2, "concurrency": 2}}
+default_rate_limits = {
+    'salesforce': {'rate': 20, 'concurrency': 10},
+    'calcom': {'rate': 5, 'concurrency': 4},
+    'google': {'rate': 10, 'concurrency': 8}
+}
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(backend) -> RateLimiter:
+    # The RateLimiter shared by every client of backend
+    with _rate_limiters_lock:
+        if backend not in _rate_limiters:
+            settings = dict(default_rate_limits.get(backend, {}))
+            settings.update(globals().get('config', {}).get('rate_limits', {}).get(backend, {}))
+            _rate_limiters[backend] = RateLimiter(backend, **settings)
+        return _rate_limiters[backend]
+
+
+def rate_limiter_for(url):
+    # Which backend a url belongs to, None for anything else
+    host = urlsplit(url).netloc or url
+    if host.endswith(('salesforce.com', 'force.com')):
+        return get_rate_limiter('salesforce')
+    if host.endswith('cal.com'):
+        return get_rate_limiter('calcom')
+    if host.endswith('googleapis.com'):
+        return get_rate_limiter('google')
+    return None
+
+
+def check_api_budget() -> None:
+    """
+    Raises BudgetExceeded once the SalesForce org has used all but
+    'api_budget_reserve' (default 10%) of its daily API calls, so
+    no new accounts are started.
+    """
+    limiter = _rate_limiters.get('salesforce')
+    reserve = float(globals().get('config', {}).get('api_budget_reserve', 0.1))
+    if limiter and limiter.over_budget(reserve):
+        used, limit = limiter.api_usage
+        raise BudgetExceeded(f'SalesForce has used {used} of its {limit} daily API calls. '
+                             f'Stopped starting new accounts.')
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests.Session that uses a default timeout for every
+    call that doesn't pass its own, and goes through the
+    backend's RateLimiter when it has one.
+    """
+    def __init__(self, timeout, limiter=None) -> None:
+        super().__init__()
+        self.timeout = timeout
+        self.limiter = limiter
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        send = super().request
+        if self.limiter is None:
+            return send(method, url, **kwargs)
+        return self.limiter.call(lambda: send(method, url, **kwargs), method=method)
+
+
+class HttpTransport:
+    """
+    Hands out one pooled keep-alive session per host, so calls
+    reuse open connections instead of doing a new TCP and TLS
+    handshake every time.
+    """
+    def __init__(self, pool_size=20, timeout=(10, 60)) -> None:
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+
+    def session(self, url) -> requests.Session:
+        host = urlsplit(url).netloc or url
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = TimeoutSession(timeout=self.timeout, limiter=rate_limiter_for(url))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[host] = session
+            return session
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HttpTransport:
+    """
+    The HttpTransport shared by every client. Pool size and
+    timeouts come from 'http_pool_size' and 'http_timeout'
+    (seconds) in config.json when they are set.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            settings = globals().get('config', {})
+            _transport = HttpTransport(pool_size=int(settings.get('http_pool_size', 20)),
+                                       timeout=float(settings.get('http_timeout', 60)))
+        return _transport
+
+
 class CredentialsManager:
     def __init__(self) -> None:
         self.logger = get_logger(module='CredentialsManager')       
+        self.token_provider = SalesForceTokenProvider(manager=self)
+        self.password = None
         
     
     def load_config(self) -> bool:
@@ -59,6 +489,15 @@ class CredentialsManager:
 
 
     def salesforce_access_token(self) -> bool:
+        """
+        Makes sure there is a SalesForce access token to make
+        calls against the api: the saved one while it hasn't
+        expired, otherwise a new one (see request_access_token).
+        """
+        return self.token_provider.get() is not None
+
+
+    def request_access_token(self) -> bool:
         """
         Uses your SalesForce account + the SalesForce
         Connected App for this script and gets an
@@ -67,10 +506,14 @@ class CredentialsManager:
         if config.get('store_password') == "True":
             password = config.get('password')
         else:
-            password = getpass('Input your SalesForce password: ')
+            # Only ask once per run, even if the token is refreshed later
+            if self.password is None:
+                self.password = getpass('Input your SalesForce password: ')
+            password = self.password
         
-        response = requests.post(
-         'https://login.salesforce.com/services/oauth2/token',
+        login_url = 'https://login.salesforce.com/services/oauth2/token'
+        response = get_transport().session(login_url).post(
+         login_url,
          data={
             'grant_type': 'password',
             'client_id': config['consumer_key'],
@@ -83,23 +526,84 @@ class CredentialsManager:
         if response.status_code == 200:
             token_data = response.json()
             config['access_token'] = token_data['access_token']
+            config['access_token_issued_at'] = int(token_data.get('issued_at', 0)) / 1000 or time()
             self.save_config()
             return True
         else:
             self.logger.error(f'Failed to refresh SalesForce access_token '
-                            'with code: {response.status_code}')
+                            f'with code: {response.status_code}')
             self.logger.error(response.content)
             return False
 
 
+class SalesForceTokenProvider:
+    """
+    Hands out the SalesForce access token to the requests calls
+    and the simple_salesforce client alike. The token saved in
+    config.json is reused until 'session_lifetime' seconds
+    (default 7200) have passed since it was issued. When SalesForce
+    refuses a token, refresh() gets a new one, once, no matter how
+    many threads saw the refusal.
+    """
+    def __init__(self, manager) -> None:
+        self.manager = manager
+        self.lock = threading.Lock()
+
+
+    def get(self):
+        # A token that should still be valid, or None if one can't be had
+        with self.lock:
+            if not self._valid():
+                self.manager.request_access_token()
+            return config.get('access_token') if self._valid() else None
+
+
+    def refresh(self, stale_token):
+        """
+        Called with the token SalesForce just refused. Only gets a
+        new one if nobody else has yet. Returns the token to retry
+        with, or None.
+        """
+        with self.lock:
+            if config.get('access_token') == stale_token:
+                if not self.manager.request_access_token():
+                    return None
+            return config.get('access_token')
+
+
+    def _valid(self) -> bool:
+        issued_at = config.get('access_token_issued_at')
+        lifetime = float(config.get('session_lifetime', 7200))
+        # Leave a few minutes so a call doesn't start on a token about to expire
+        return bool(config.get('access_token')) and bool(issued_at) and time() - issued_at < lifetime - 300
+
+
 class SalesForceAutomation:
-    def __init__(self) -> None:
+    def __init__(self, flush_updates_at=200, token_provider=None) -> None:
         self.logger = get_logger(module='SalesForceAutomation')
-        self.sf = Salesforce(session_id=config['access_token'], instance_url=config['instance_url'])
-        self.headers = {
-                  'Authorization': f'Bearer {config["access_token"]}',
-                  'Content-Type': 'application/json'
-                    }
+        self.token_provider = token_provider or CredentialsManager().token_provider
+        self.session = get_transport().session(config['instance_url'])
+        self.sf = Salesforce(session_id=self.token_provider.get(), instance_url=config['instance_url'],
+                             session=self.session)
+        self.headers = {'Content-Type': 'application/json'}
+        # Filled in by prefetch_account_updates
+        self.account_update_index = {'by_name': {}, 'by_id': {}}
+        # Filled in by prefetch_assets
+        self.asset_index = {}
+        # Write-behind buffer for queue_account_update. Reaching
+        # flush_updates_at queued records flushes the buffer
+        # automatically; 0 or None only flushes when asked.
+        self.flush_updates_at = flush_updates_at
+        self.pending_updates = {}
+        self.update_results = {}
+        self.update_lock = threading.Lock()
+        # Worker threads share self.sf, so swapping its token is locked
+        self.token_lock = threading.Lock()
+
+        # Emails waiting for flush_emails_with_template
+        self.pending_emails = {}
+        self.email_results = {}
+        self.email_lock = threading.Lock()
         self.email_templates_mapping = {
             'VOW Full': {
                 'Normal': '00X4v000002oCuOEAU',
@@ -108,53 +612,258 @@ class SalesForceAutomation:
         }
   
 
-    def get_report(self, report_id: str) -> DataFrame:
+    def request(self, method, url, headers=None, **kwargs):
+        """
+        Sends a request to SalesForce with the current access token.
+        If the token was refused (401) it is refreshed and the
+        request is sent once more.
+        """
+        token = self.token_provider.get()
+        headers = dict(self.headers, **(headers or {}), Authorization=f'Bearer {token}')
+        response = self.session.request(method, url, headers=headers, **kwargs)
+
+        if response.status_code == 401:
+            new_token = self.token_provider.refresh(stale_token=token)
+            if new_token and new_token != token:
+                response.close()
+                headers['Authorization'] = f'Bearer {new_token}'
+                response = self.session.request(method, url, headers=headers, **kwargs)
+        return response
+
+
+    def call_sf(self, call):
+        """
+        Runs call() against the simple_salesforce client, giving
+        it a new access token and running it again if SalesForce
+        says the session expired.
+        """
+        token = self.token_provider.get()
+        if token:
+            self._use_token(token)
+
+        try:
+            return call()
+        except SalesforceExpiredSession:
+            new_token = self.token_provider.refresh(stale_token=token)
+            if not new_token or new_token == token:
+                raise
+            self._use_token(new_token)
+            return call()
+
+
+    def _use_token(self, token) -> None:
+        with self.token_lock:
+            if token == self.sf.session_id:
+                return
+            self.sf.session_id = token
+            self.sf.headers['Authorization'] = f'Bearer {token}'
+
+
+    def get_report(self, report_id: str, sort_column='Account Update', as_records=False):
       """
       Gets the data from a report and makes a nice table
       to pull data from. Can print the dataframe in your
       terminal to see all the data presented to you!
+      With as_records=True you get a list of ReportRow
+      instead, which doesn't need pandas.
       """
-      report_url = f'{config["instance_url"]}/services/data/v61.0/analytics/reports/{report_id}'
-      response = requests.get(report_url, headers=self.headers)
-
-      if response.status_code == 200:
-         report_data = response.json()
-         rows = report_data['factMap']['0!T']['rows']
-         columns = report_data['reportMetadata']['detailColumns']
-
-         # Extract column labels
-         column_labels = []
-         for column in columns:
-            column_info = report_data['reportExtendedMetadata']['detailColumnInfo'].get(column, {})
-            column_labels.append(column_info.get('label', column))
-
-         # Extract row data
-         data = []
-         for row in rows:
-            row_data = [cell.get('label', '') for cell in row['dataCells']]
-            data.append(row_data)
-
-         # Create DataFrame
-         dataframe = pd.DataFrame(data, columns=column_labels)
-         if dataframe.empty:
-            self.logger.error('The report is empty.')
-            self.logger.error(response.content)
-            reason = 'The report is empty!'
-            return False, reason, None
-         else:
-            self.logger.info(f'Report ID ({report_id}) obtained successfully!\n {dataframe}')
-            return True, None, dataframe
-         
-      else:
-         self.logger.error(f"Failed to get arrived report: {response.status_code}")
-         self.logger.error(response.content)
-         reason = response.content
+      if not as_records and pd is None:
+         reason = 'pandas is not installed. Use as_records=True or install pandas.'
+         self.logger.error(reason)
+         return False, reason, None
+
+      try:
+         records = list(self.iter_report(report_id=report_id, sort_column=sort_column))
+      except ReportError as error:
+         return False, error.reason, None
+
+      if not records:
+         self.logger.error('The report is empty.')
+         reason = 'The report is empty!'
          return False, reason, None
 
+      if as_records:
+         self.logger.info(f'Report ID ({report_id}) obtained successfully! ({len(records)} rows)')
+         return True, None, records
+
+      # Create DataFrame
+      dataframe = pd.DataFrame([record.values for record in records], columns=records[0].keys())
+      self.logger.info(f'Report ID ({report_id}) obtained successfully!\n {dataframe}')
+      return True, None, dataframe
+
+
+    def iter_report(self, report_id: str, sort_column='Account Update'):
+        """
+        Yields the rows of a report one at a time as
+        ReportRow records, fetching the next page only
+        when the current one runs out.
+
+        Like the old get_report, only the rows of the report's
+        first grouping are read (the saved report is grouped,
+        e.g. by status, and the first group is the one we work).
+
+        A single Reports API run stops at 2,000 rows, so the
+        report is run as a plain table filtered to the first
+        group's value and sorted by sort_column, and each next
+        page is filtered to rows past the last value seen.
+        sort_column must be unique in the report
+        (e.g. the Account Update name). Without it only the
+        first page can be read, and a warning is logged if
+        rows were left out.
+        Raises ReportError if SalesForce refuses the report.
+        """
+        report_url = f'{config["instance_url"]}/services/data/v61.0/analytics/reports/{report_id}'
+        response = self.request('GET', f'{report_url}/describe')
+        if response.status_code != 200:
+            self.logger.error(f"Failed to describe report {report_id}: {response.status_code}")
+            self.logger.error(response.content)
+            raise ReportError(response.content)
+
+        describe = response.json()
+        metadata = describe['reportMetadata']
+        columns = metadata['detailColumns']
+        column_info = describe['reportExtendedMetadata']['detailColumnInfo']
+
+        # Extract column labels
+        column_labels = [column_info.get(column, {}).get('label', column) for column in columns]
+        positions = {label: index for index, label in enumerate(column_labels)}
+
+        sort_api_name = None
+        if sort_column in column_labels:
+            sort_api_name = columns[column_labels.index(sort_column)]
+        else:
+            self.logger.warning(f'Column "{sort_column}" is not in report {report_id}. '
+                                'Only the first 2,000 rows can be read.')
+
+        base_filters = list(metadata.get('reportFilters') or [])
+        boolean_filter = metadata.get('reportBooleanFilter')
+
+        # Keep to the first grouping's rows (factMap '0!T' of the saved report)
+        groupings = metadata.get('groupingsDown') or []
+        if groupings:
+            response = self.request('GET', report_url, params={'includeDetails': 'false'})
+            if response.status_code != 200:
+                self.logger.error(f"Failed to get report {report_id}: {response.status_code}")
+                self.logger.error(response.content)
+                raise ReportError(response.content)
+
+            first_groups = response.json().get('groupingsDown', {}).get('groupings', [])
+            if not first_groups:
+                self.logger.info(f'Report {report_id} has no rows.')
+                return
+            group = first_groups[0]
+            self.logger.info(f'Reading the "{group.get("label")}" group of report {report_id}')
+            base_filters.append({'column': groupings[0]['name'],
+                                 'operator': 'equals',
+                                 'value': group.get('value') if group.get('value') is not None else ''})
+            if boolean_filter:
+                boolean_filter = f'({boolean_filter}) AND {len(base_filters)}'
+
+        # Run the report ungrouped so the sort order covers every row
+        metadata = dict(metadata,
+                        reportFormat='TABULAR',
+                        groupingsDown=[],
+                        groupingsAcross=[],
+                        aggregates=['RowCount'])
+        if sort_api_name:
+            metadata['sortBy'] = [{'sortColumn': sort_api_name, 'sortOrder': 'Asc'}]
+        metadata['reportFilters'] = base_filters
+        if boolean_filter:
+            metadata['reportBooleanFilter'] = boolean_filter
+
+        last_value = None
+        page = 0
+        while True:
+            page_metadata = dict(metadata)
+            if last_value is not None:
+                page_metadata['reportFilters'] = base_filters + [
+                    {'column': sort_api_name, 'operator': 'greaterThan', 'value': last_value}]
+                if boolean_filter:
+                    page_metadata['reportBooleanFilter'] = f'({boolean_filter}) AND {len(base_filters) + 1}'
+
+            response = self.request('POST', report_url,
+                                    params={'includeDetails': 'true'},
+                                    json={'reportMetadata': page_metadata})
+            if response.status_code != 200:
+                self.logger.error(f"Failed to get report {report_id}: {response.status_code}")
+                self.logger.error(response.content)
+                raise ReportError(response.content)
+
+            report_data = response.json()
+            rows = report_data['factMap']['T!T'].get('rows', [])
+            page += 1
+            self.logger.info(f'Report {report_id} page {page}: {len(rows)} rows')
+
+            for row in rows:
+                yield ReportRow(positions, tuple(cell.get('label', '') for cell in row['dataCells']))
+
+            if report_data.get('allData', True) or not rows:
+                return
+            if not sort_api_name:
+                self.logger.warning(f'Report {report_id} has more than {len(rows)} rows. The rest were not read.')
+                return
+            last_value = rows[-1]['dataCells'][columns.index(sort_api_name)].get('label')
+
+
+    def prefetch_assets(self, account_updates: list, asset_names: list, fields: list, chunk_size=200) -> dict:
+        """
+        Loads the Assets of every account in the report with a few
+        AccountId IN (...) queries. Uses the Account__c values from
+        prefetch_account_updates, so run that first.
+        Returns {(account_update, asset_name): {field: value} or None}
+        """
+        account_ids = {}
+        for name in dict.fromkeys(account_updates):
+            record = self.account_update_index['by_name'].get(name)
+            if record and record.get('Account__c'):
+                account_ids.setdefault(record['Account__c'], []).append(name)
+
+        fields = list(dict.fromkeys(['AccountId', 'Name'] + fields))
+        variables = ', '.join(fields)
+        name_filter = ' OR '.join(f"Name LIKE {soql_quote('%' + asset_name + '%')}"
+                                  for asset_name in asset_names)
+
+        # Every pair we asked about is recorded, even when nothing
+        # was found, so get_asset_info doesn't query for it again
+        index = {(name, asset_name): None
+                 for names in account_ids.values()
+                 for name in names
+                 for asset_name in asset_names}
+
+        for chunk in chunks(list(account_ids), chunk_size):
+            in_clause = ', '.join(soql_quote(account_id) for account_id in chunk)
+            query = f"""
+                    SELECT {variables}
+                    FROM Asset
+                    WHERE AccountId IN ({in_clause}) AND ({name_filter})
+                    """
+            response = self.call_sf(lambda: self.sf.query_all(query))
+            for record in response['records']:
+                for asset_name in asset_names:
+                    if asset_name.lower() not in (record.get('Name') or '').lower():
+                        continue
+                    for name in account_ids[record['AccountId']]:
+                        if index[(name, asset_name)] is None:
+                            index[(name, asset_name)] = {field: record.get(field) for field in fields}
+
+        self.logger.info(f'Prefetched Assets for {len(account_ids)} accounts.')
+        self.asset_index.update(index)
+        return index
+
 
     def get_asset_info(self, account_update, asset_name, fields: list) -> dict:
+        key = (account_update, asset_name)
+        if key in self.asset_index:
+            record = self.asset_index[key]
+            if record is None:
+                error = f'    X Could not find {asset_name} in SalesForce. (Likely not assetted)'
+                self.logger.error(f'No {asset_name} Asset found for {account_update}')
+                return error, None
+            if all(field in record for field in fields):
+                return False, {field: record[field] for field in fields}
+
         query = f"SELECT Account__c FROM Account_Update__c WHERE Name = '{account_update}'"
-        response = self.sf.query(query)
+        response = self.call_sf(lambda: self.sf.query(query))
         account_id = response['records'][0]['Account__c']
 
         variables = ', '.join(fields)
@@ -163,7 +872,7 @@ class SalesForceAutomation:
                 FROM Asset
                 WHERE AccountId = '{account_id}' AND Name LIKE '%{asset_name}%'
                 """
-        response = self.sf.query(query)
+        response = self.call_sf(lambda: self.sf.query(query))
         try:
             result = {field: response['records'][0][field] for field in fields}
         
@@ -175,22 +884,327 @@ class SalesForceAutomation:
         return False, result
 
 
+    def count_query(self, query: str) -> int:
+        # Number of rows a SOQL query would return, without fetching them
+        count_query = re.sub(r'^\s*SELECT\s.+?\sFROM\s', 'SELECT COUNT() FROM ',
+                             query, count=1, flags=re.IGNORECASE | re.DOTALL)
+        return self.call_sf(lambda: self.sf.query(count_query))['totalSize']
+
+
+    def iter_bulk_query(self, query: str, column_labels: dict, formatters=None, page_size=50000,
+                        poll_interval=2, timeout=900):
+        """
+        Runs a SOQL query as a Bulk API 2.0 query job and yields
+        its rows as ReportRow records. The CSV results are
+        read straight off the connection a page at a time, so the
+        whole export is never held in memory.
+
+        column_labels maps the CSV columns (e.g. 'Account__r.Name')
+        to the labels the report uses (e.g. 'Account Name').
+        formatters maps CSV columns to functions that turn the raw
+        values into what the report shows (see bulk_formatters).
+        Raises ReportError if the job can't be run or hasn't
+        finished after timeout seconds.
+        """
+        jobs_url = f'{config["instance_url"]}/services/data/v61.0/jobs/query'
+        response = self.request('POST', jobs_url,
+                                json={'operation': 'query', 'query': query})
+        if response.status_code not in (200, 201):
+            self.logger.error(f'Failed to start Bulk API query job: {response.status_code}')
+            self.logger.error(response.content)
+            raise ReportError(response.content)
+        job_id = response.json()['id']
+        self.logger.info(f'Started Bulk API query job {job_id}')
+
+        # Wait for SalesForce to finish the job
+        deadline = monotonic() + timeout
+        while True:
+            response = self.request('GET', f'{jobs_url}/{job_id}')
+            state = response.json().get('state') if response.status_code == 200 else None
+            if state == 'JobComplete':
+                break
+            if state in ('Failed', 'Aborted') or response.status_code != 200:
+                self.logger.error(f'Bulk API query job {job_id} did not finish: {response.content}')
+                raise ReportError(response.content)
+            if monotonic() > deadline:
+                self.request('PATCH', f'{jobs_url}/{job_id}', json={'state': 'Aborted'})
+                reason = f'Bulk API query job {job_id} did not finish within {timeout} seconds.'
+                self.logger.error(reason)
+                raise ReportError(reason)
+            sleep(poll_interval)
+
+        formatters = formatters or {}
+
+        locator = None
+        page = 0
+        while True:
+            params = {'maxRecords': page_size}
+            if locator:
+                params['locator'] = locator
+
+            with self.request('GET', f'{jobs_url}/{job_id}/results', headers={'Accept': 'text/csv'},
+                              params=params, stream=True) as response:
+                if response.status_code != 200:
+                    self.logger.error(f'Failed to read Bulk API results for job {job_id}: {response.status_code}')
+                    self.logger.error(response.content)
+                    raise ReportError(response.content)
+
+                response.raw.decode_content = True
+                reader = csv.reader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''))
+                columns = next(reader, [])
+                labels = [column_labels.get(column, column) for column in columns]
+                positions = {label: index for index, label in enumerate(labels)}
+                formats = [formatters.get(column) for column in columns]
+                if any(formats):
+                    formats = [format_value or str for format_value in formats]
+                    for values in reader:
+                        yield ReportRow(positions, tuple(format_value(value) for format_value, value
+                                                         in zip(formats, values)))
+                else:
+                    for values in reader:
+                        yield ReportRow(positions, tuple(values))
+
+                locator = response.headers.get('Sforce-Locator')
+            page += 1
+            self.logger.info(f'Read page {page} of Bulk API query job {job_id}')
+
+            if not locator or locator == 'null':
+                return
+
+
+    def iter_report_rows(self, report_id: str, query=None, column_labels=None, bulk_threshold=2000):
+        """
+        Yields the report's rows, choosing how to read them. When
+        query (the report written as SOQL) would return more than
+        bulk_threshold rows it is exported with iter_bulk_query,
+        otherwise the report is read with iter_report.
+        """
+        if query:
+            try:
+                row_count = self.count_query(query)
+            except Exception as error:
+                self.logger.warning(f'Could not count the report rows, reading the report instead: {error}')
+                row_count = 0
+            if row_count > bulk_threshold:
+                self.logger.info(f'{row_count} rows is over {bulk_threshold}. Exporting with the Bulk API.')
+                column_labels = column_labels or {}
+                formatters = self.bulk_formatters(report_id=report_id, query=query,
+                                                  column_labels=column_labels)
+                return self.iter_bulk_query(query=query, column_labels=column_labels,
+                                            formatters=formatters)
+        return self.iter_report(report_id=report_id)
+
+
+    def bulk_formatters(self, report_id: str, query: str, column_labels: dict) -> dict:
+        """
+        The Bulk API returns raw API values (2024-05-14,
+        2024-05-14T18:30:00.000Z, picklist API names) where the
+        report shows labels (5/14/2024, 5/14/2024, 2:30 PM, picklist
+        labels). Works out from the report's column types and the
+        object's picklist labels how to turn each CSV column into
+        what the report shows. Dates and times use the US format
+        and the SalesForce user's time zone. Other types are left
+        as they are. Returns {csv column: function}.
+        """
+        report_url = f'{config["instance_url"]}/services/data/v61.0/analytics/reports/{report_id}'
+        response = self.request('GET', f'{report_url}/describe')
+        if response.status_code != 200:
+            raise ReportError(response.content)
+        column_info = response.json()['reportExtendedMetadata']['detailColumnInfo']
+        data_types = {info.get('label'): info.get('dataType') for info in column_info.values()}
+
+        # Picklist labels of the queried object's own fields
+        sobject = re.search(r'\sFROM\s+(\w+)', query, flags=re.IGNORECASE).group(1)
+        describe = self.call_sf(lambda: getattr(self.sf, sobject).describe())
+        picklists = {field['name']: {value['value']: value['label'] for value in field.get('picklistValues', [])}
+                     for field in describe['fields'] if field.get('picklistValues')}
+
+        user_timezone = None
+        formatters = {}
+        for column, label in column_labels.items():
+            data_type = (data_types.get(label) or '').lower()
+            if data_type == 'date':
+                formatters[column] = self._format_date
+            elif data_type == 'datetime':
+                if user_timezone is None:
+                    user_timezone = self._user_timezone()
+                formatters[column] = lambda value, tz=user_timezone: self._format_datetime(value, tz)
+            elif data_type in ('picklist', 'multipicklist') and column in picklists:
+                formatters[column] = lambda value, labels=picklists[column]: ';'.join(
+                    labels.get(item, item) for item in value.split(';')) if value else value
+        return formatters
+
+
+    def _user_timezone(self):
+        query = f"SELECT TimeZoneSidKey FROM User WHERE Username = {soql_quote(config['username'])}"
+        records = self.call_sf(lambda: self.sf.query(query))['records']
+        return pytz.timezone(records[0]['TimeZoneSidKey']) if records else pytz.utc
+
+
+    @staticmethod
+    def _format_date(value) -> str:
+        if not value:
+            return value
+        day = date.fromisoformat(value[:10])
+        return f'{day.month}/{day.day}/{day.year}'
+
+
+    @staticmethod
+    def _format_datetime(value, tz) -> str:
+        if not value:
+            return value
+        moment = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=dt_timezone.utc).astimezone(tz)
+        hour = moment.hour % 12 or 12
+        return f'{moment.month}/{moment.day}/{moment.year}, {hour}:{moment.minute:02d} {"AM" if moment.hour < 12 else "PM"}'
+
+
+    def prefetch_account_updates(self, account_updates: list, fields: list, chunk_size=200) -> dict:
+        """
+        Loads every Account Update in the report with a few
+        IN (...) queries instead of one query per row. The
+        result is kept so get_account_update_info and
+        get_contact_id don't need to ask SalesForce again.
+        Can be called again for more names; the index grows.
+        Returns {'by_name': {...}, 'by_id': {...}} for this call
+        """
+        fields = list(dict.fromkeys(['Id', 'Name', 'Contact__c', 'Account__c'] + fields))
+        variables = ', '.join(fields)
+        names = list(dict.fromkeys(name for name in account_updates if name))
+
+        by_name = {}
+        by_id = {}
+        for chunk in chunks(names, chunk_size):
+            in_clause = ', '.join(soql_quote(name) for name in chunk)
+            query = f"SELECT {variables} FROM Account_Update__c WHERE Name IN ({in_clause})"
+            response = self.call_sf(lambda: self.sf.query_all(query))
+            for record in response['records']:
+                record = {field: record.get(field) for field in fields}
+                by_name[record['Name']] = record
+                by_id[record['Id']] = record
+
+        missing = len(names) - len(by_name)
+        if missing:
+            self.logger.warning(f'{missing} Account Update(s) from the report were not found in SalesForce.')
+        self.logger.info(f'Prefetched {len(by_name)} Account Updates.')
+
+        self.account_update_index['by_name'].update(by_name)
+        self.account_update_index['by_id'].update(by_id)
+        return {'by_name': by_name, 'by_id': by_id}
+
+
     def get_account_update_info(self, account_update, fields:list) -> dict:
+        record = self.account_update_index['by_name'].get(account_update)
+        if record and all(field in record for field in fields):
+            return {field: record[field] for field in fields}
+
         variables = ', '.join(fields)
         query = f"SELECT {variables} FROM Account_Update__c WHERE Name = '{account_update}'"
-        response = self.sf.query(query)
+        response = self.call_sf(lambda: self.sf.query(query))
         result = {field: response['records'][0][field] for field in fields}
         return result
     
 
     def update_account_update(self, account_update_id, payload):
-        self.sf.Account_Update__c.update(account_update_id, payload)
+        self.call_sf(lambda: self.sf.Account_Update__c.update(account_update_id, payload))
+
+
+    def queue_account_update(self, account_update_id, payload) -> None:
+        """
+        Like update_account_update, but the change is held until
+        flush_account_updates. Payloads for the same record are
+        merged, later values winning.
+        """
+        with self.update_lock:
+            self.pending_updates.setdefault(account_update_id, {}).update(payload)
+            full = self.flush_updates_at and len(self.pending_updates) >= self.flush_updates_at
+
+        if full:
+            self.flush_account_updates()
+
+
+    def flush_account_updates(self, chunk_size=200) -> dict:
+        """
+        Sends every queued Account Update change through the
+        sObject Collections endpoint, up to 200 records a call.
+        Returns {account_update_id: (success, errors)} for this
+        flush. Results are also kept in self.update_results.
+        """
+        with self.update_lock:
+            pending = self.pending_updates
+            self.pending_updates = {}
+
+        results = {}
+        for chunk in chunks(list(pending.items()), chunk_size):
+            records = [{'attributes': {'type': 'Account_Update__c'}, 'id': record_id, **payload}
+                       for record_id, payload in chunk]
+            try:
+                response = self.call_sf(lambda: self.sf.restful('composite/sobjects', method='PATCH',
+                                                                json={'allOrNone': False, 'records': records}))
+            except Exception as error:
+                self.logger.error(f'Failed to update {len(chunk)} Account Updates: {error}')
+                for record_id, _ in chunk:
+                    results[record_id] = (False, [str(error)])
+                continue
+
+            for (record_id, _), result in zip(chunk, response):
+                errors = result.get('errors') or []
+                results[record_id] = (result.get('success', False), errors)
+                if errors:
+                    self.logger.error(f'Failed to update Account Update {record_id}: {errors}')
+
+        if results:
+            self.logger.info(f'Flushed {len(results)} Account Update(s).')
+        with self.update_lock:
+            self.update_results.update(results)
+        return results
 
 
     def send_email_with_template(self, template_logic: dict, contact_id, account_update_id):
         """
         template_logic = {'ivr_type': 'VOW Full', 'self install': True}
         """
+        flow_input = self._flow_input(template_logic, contact_id, account_update_id)
+        success, _ = self._invoke_email_flow([flow_input])[0]
+        return success
+
+
+    def queue_email_with_template(self, template_logic: dict, contact_id, account_update_id) -> None:
+        """
+        Like send_email_with_template, but the email is held until
+        flush_emails_with_template and sent with the others.
+        """
+        flow_input = self._flow_input(template_logic, contact_id, account_update_id)
+        with self.email_lock:
+            self.pending_emails[account_update_id] = flow_input
+
+
+    def flush_emails_with_template(self, chunk_size=100) -> dict:
+        """
+        Runs the Email_From_Account_Update flow for every queued
+        email, chunk_size inputs a call. Returns
+        {account_update_id: (success, errors)} for this flush.
+        Results are also kept in self.email_results.
+        """
+        with self.email_lock:
+            pending = self.pending_emails
+            self.pending_emails = {}
+
+        results = {}
+        for chunk in chunks(list(pending.items()), chunk_size):
+            flow_results = self._invoke_email_flow([flow_input for _, flow_input in chunk])
+            for (account_update_id, _), result in zip(chunk, flow_results):
+                results[account_update_id] = result
+                if not result[0]:
+                    self.logger.error(f'Failed to send the email for {account_update_id}: {result[1]}')
+
+        if results:
+            self.logger.info(f'Ran the email flow for {len(results)} Account Update(s).')
+        with self.email_lock:
+            self.email_results.update(results)
+        return results
+
+
+    def _flow_input(self, template_logic: dict, contact_id, account_update_id) -> dict:
         ivr_key = template_logic.get('ivr_type')
         self_install = template_logic.get('self install')
 
@@ -204,26 +1218,37 @@ class SalesForceAutomation:
             else:
                 template_id = self.email_templates_mapping[ivr_key].get('Normal')
 
-        payload = {
-            'inputs': [
-                        {'Template_Id': template_id,
-                        'Recipient_Id': contact_id,
-                        'Account_Update_Id': account_update_id}
-                        ]
-                    }
+        return {'Template_Id': template_id,
+                'Recipient_Id': contact_id,
+                'Account_Update_Id': account_update_id}
 
+
+    def _invoke_email_flow(self, flow_inputs: list) -> list:
+        # One (success, errors) per input, in the same order
         flow_url = f'{config["instance_url"]}/services/data/v61.0/actions/custom/flow/Email_From_Account_Update'
-        response = requests.post(flow_url, headers=self.headers, json=payload)
+        try:
+            response = self.request('POST', flow_url, json={'inputs': flow_inputs})
+        except Exception as error:
+            return [(False, [str(error)])] * len(flow_inputs)
 
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        if response.status_code != 200:
+            self.logger.error(f'The email flow failed with code {response.status_code}: {response.text}')
+            return [(False, [f'HTTP {response.status_code}'])] * len(flow_inputs)
+
+        results = [(bool(result.get('isSuccess')), result.get('errors') or [])
+                   for result in response.json()]
+        # Inputs the response didn't mention count as failed
+        results += [(False, ['No result returned'])] * (len(flow_inputs) - len(results))
+        return results
 
 
     def get_contact_id(self, account_update_id):
+        record = self.account_update_index['by_id'].get(account_update_id)
+        if record:
+            return record['Contact__c']
+
         query = f"SELECT Contact__c FROM Account_Update__c WHERE Id = '{account_update_id}'"
-        response = self.sf.query(query)
+        response = self.call_sf(lambda: self.sf.query(query))
         if response['totalSize'] > 0:
             return response['records'][0]['Contact__c']
         else:
@@ -252,19 +1277,383 @@ class SalesForceAutomation:
     def get_account_info(self, account_update_id, fields: list):
         variables = ', '.join(fields)
         query = f'SELECT {variables} FROM Account_Update__c WHERE Id = "{account_update_id}"'
-        response = self.sf.query(query)
+        response = self.call_sf(lambda: self.sf.query(query))
         result = {field: response['records'][0][field] for field in fields}
         return result
 
 
+class FieldExtractor:
+    """
+    Reads "Label: value" fields out of a document. Like the old
+    line-by-line scan, a field found again further down the document
+    overwrites the earlier value (the last one wins), so each label
+    is searched for backwards from the end of the text and the
+    search stops at the first line that has a value for it.
+
+    fields maps a name to its label, or to (label, words) when
+    lines containing any of those words should be ignored:
+        FieldExtractor({'vendor': 'Pharmacy Software Vendor',
+                        'ip': ('IP Address:', ('Pharmacy', 'Public'))})
+    """
+    def __init__(self, fields: dict) -> None:
+        self.labels = {}
+        self.excluded = {}
+        for name, spec in fields.items():
+            label, excluded = (spec, ()) if isinstance(spec, str) else spec
+            self.labels[name] = label
+            self.excluded[name] = tuple(excluded)
+
+
+    def extract(self, document) -> dict:
+        """
+        document is the text, or any iterable of its lines.
+        Returns {name: value}, with None for fields not found.
+        The value is what follows the line's first ':'.
+        """
+        if not isinstance(document, str):
+            document = '\n'.join(document)
+
+        found = {}
+        for name, label in self.labels.items():
+            # str.rfind does the searching, so only lines with
+            # the label in them are ever cut out of the text
+            end = len(document)
+            while True:
+                at = document.rfind(label, 0, end)
+                if at == -1:
+                    break
+                line_start = document.rfind('\n', 0, at) + 1
+                line_end = document.find('\n', at + len(label))
+                line = document[line_start:line_end if line_end != -1 else len(document)]
+                if not any(word in line for word in self.excluded[name]):
+                    parts = line.split(':')
+                    if len(parts) > 1:
+                        found[name] = parts[1].strip()
+                        break
+                # Nothing usable on this line, keep looking above it
+                end = line_start
+
+        return {name: found.get(name) for name in self.labels}
+
+
+class DriveIndex:
+    """
+    Remembers between runs which file a document title points to
+    in each customer folder, along with the text exported from it.
+    GoogleDriveAutomation.sync_drive_index keeps it in step with
+    the Drive changes feed, so unchanged documents are neither
+    looked up nor downloaded again.
+    """
+    def __init__(self, path='keys/drive_index.sqlite3') -> None:
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    folder_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    modified TEXT,
+                    text TEXT,
+                    mime_type TEXT,
+                    PRIMARY KEY (folder_id, title))
+                """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS documents_file_id ON documents (file_id)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT)
+                """)
+
+
+    def lookup(self, folder_id, title, mime_type):
+        # {'file_id', 'modified', 'text'} for the title and type in the folder, or None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT file_id, modified, text FROM documents WHERE folder_id = ? AND title = ? AND mime_type = ?",
+                (folder_id, title, mime_type)).fetchone()
+        if row is None:
+            return None
+        return {'file_id': row[0], 'modified': row[1], 'text': row[2]}
+
+
+    def store(self, folder_id, title, file_id, modified, text=None, mime_type=None) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (folder_id, title, file_id, modified, text, mime_type) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (folder_id, title, file_id, modified, text, mime_type))
+
+
+    def forget(self, file_ids=(), folder_titles=()) -> None:
+        """
+        Drops the entries for changed files, and for any folder that
+        now holds a file with the same title as one we remember.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM documents WHERE file_id = ?",
+                                        [(file_id,) for file_id in file_ids])
+            self.connection.executemany("DELETE FROM documents WHERE folder_id = ? AND title = ?",
+                                        list(folder_titles))
+
+
+    def clear(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM documents")
+
+
+    def get_setting(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+    def set_setting(self, key, value) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+
+class FirewallRulesError(Exception):
+    def __init__(self, reason) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class FirewallRulesTemplate:
+    """
+    The firewall rules sheet's formulas, read once per run. Each
+    account's values are put in the input cells and the sheet's
+    simple formulas (=B30, ="text"&B29, =CONCATENATE(...)) are
+    worked out here, so the PDF can be made locally for many
+    accounts at once without touching the shared spreadsheet.
+
+    The values the sheet shows are never used, they belong to
+    whichever account was filled in last. A formula that can't
+    be worked out raises FirewallRulesError.
+    """
+    inputs = {
+        'B29': 'pbx_hostname',
+        'B30': 'pbx_ip_address',
+        'B31': 'opie_mac_address',
+        'B32': 'opie_ip_address',
+        'B34': 'pms_server_ip'
+    }
+    cell_pattern = re.compile(r'^\$?([A-Z]{1,2})\$?(\d+)$')
+    concatenate_pattern = re.compile(r'^CONCATENATE\((.*)\)$', re.IGNORECASE | re.DOTALL)
+    line_height = 4.5
+
+    def __init__(self, formulas) -> None:
+        # formulas are the sheet's rows as gspread returns them
+        # with the FORMULA render option
+        self.formulas = formulas
+        self.width = max((len(row) for row in formulas), default=0)
+
+
+    @classmethod
+    def from_sheet(cls, sheet):
+        return cls(sheet.get(value_render_option='FORMULA'))
+
+
+    def fill(self, **values) -> list:
+        # The sheet's rows with this account's values filled in
+        return [[self._cell(row, col, values) for col in range(self.width)]
+                for row in range(len(self.formulas))]
+
+
+    def render_pdf(self, **values) -> bytes:
+        rows = self.fill(**values)
+        while rows and not any(rows[-1]):
+            rows.pop()
+        rows = [[text.encode('latin-1', 'replace').decode('latin-1') for text in row]
+                for row in rows]
+
+        pdf = FPDF(format='letter')
+        pdf.set_auto_page_break(False)
+        pdf.add_page()
+        pdf.set_font('Helvetica', size=8)
+
+        # Columns get space by how much text they hold, but no
+        # column more than half the page. Longer text wraps.
+        used = [min(max((pdf.get_string_width(row[col]) for row in rows), default=0) + 4,
+                    pdf.epw / 2)
+                for col in range(self.width)]
+        keep = [col for col in range(self.width) if used[col] > 4]
+        total = sum(used[col] for col in keep) or 1
+        widths = {col: pdf.epw * used[col] / total for col in keep}
+
+        for row in rows:
+            if not any(row):
+                pdf.ln(3)
+                continue
+
+            lines = max(len(pdf.multi_cell(widths[col], self.line_height, row[col],
+                                           dry_run=True, output='LINES'))
+                        for col in keep)
+            height = lines * self.line_height
+            if pdf.get_y() + height > pdf.h - pdf.b_margin:
+                pdf.add_page()
+
+            x, y = pdf.l_margin, pdf.get_y()
+            for col in keep:
+                if row[col]:
+                    pdf.rect(x, y, widths[col], height)
+                    pdf.set_xy(x, y)
+                    pdf.multi_cell(widths[col], self.line_height, row[col])
+                x += widths[col]
+            pdf.set_xy(pdf.l_margin, y + height)
+
+        return bytes(pdf.output())
+
+
+    def _cell(self, row, col, values, depth=0) -> str:
+        name = f'{self._column_name(col)}{row + 1}'
+        if name in self.inputs:
+            return str(values.get(self.inputs[name]) or '')
+
+        formula = self._get(self.formulas, row, col)
+        if not formula.startswith('='):
+            return formula
+        if depth > 10:
+            raise FirewallRulesError(f'{name} refers to itself.')
+
+        # Joins of quoted text and cell references are worked out,
+        # with & or CONCATENATE. Anything else can't be done here.
+        expression = formula[1:].strip()
+        match = self.concatenate_pattern.match(expression)
+        if match:
+            terms = re.findall(r'"(?:[^"]|"")*"|[^,]+', match.group(1))
+        else:
+            terms = re.findall(r'"(?:[^"]|"")*"|[^&]+', expression)
+
+        parts = []
+        for term in terms:
+            term = term.strip()
+            match = self.cell_pattern.match(term)
+            if term.startswith('"') and term.endswith('"') and len(term) > 1:
+                parts.append(term[1:-1].replace('""', '"'))
+            elif match:
+                ref_col = self._column_index(match.group(1))
+                parts.append(self._cell(int(match.group(2)) - 1, ref_col, values, depth + 1))
+            else:
+                raise FirewallRulesError(f'The formula in {name} ({formula}) can\'t be worked out locally.')
+        return ''.join(parts)
+
+
+    @staticmethod
+    def _get(rows, row, col) -> str:
+        if row < len(rows) and col < len(rows[row]):
+            return str(rows[row][col])
+        return ''
+
+
+    @staticmethod
+    def _column_name(col) -> str:
+        name = ''
+        col += 1
+        while col:
+            col, rest = divmod(col - 1, 26)
+            name = chr(65 + rest) + name
+        return name
+
+
+    @staticmethod
+    def _column_index(name) -> int:
+        index = 0
+        for letter in name:
+            index = index * 26 + ord(letter) - 64
+        return index - 1
+
+
+class HostResolver:
+    """
+    Turns PBX hostnames into IP addresses for the firewall rules.
+    Answers are kept as long as their DNS TTL says (dnspython) or
+    default_ttl seconds (socket). Failures are kept for
+    failure_ttl seconds. Only one thread looks up a given
+    hostname at a time, the others wait for its answer.
+    """
+    def __init__(self, default_ttl=300, failure_ttl=30, max_workers=8) -> None:
+        self.logger = get_logger(module='HostResolver')
+        self.default_ttl = default_ttl
+        self.failure_ttl = failure_ttl
+        self.max_workers = max_workers
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.key_locks = KeyedLocks()
+        self.pool = None
+
+
+    def resolve(self, hostname):
+        """
+        Returns the hostname's IP address and an error.
+        """
+        hostname = hostname.strip().lower().rstrip('.')
+        try:
+            return str(ip_address(hostname)), None
+        except ValueError:
+            pass
+
+        with self.key_locks.hold(hostname):
+            with self.lock:
+                entry = self.entries.get(hostname)
+            if entry is None or monotonic() > entry[0]:
+                entry = self._lookup(hostname)
+                with self.lock:
+                    self.entries[hostname] = entry
+
+        return entry[1], entry[2]
+
+
+    def prefetch(self, hostnames) -> None:
+        # Starts looking up the hostnames in the background
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                               thread_name_prefix='resolver')
+        for hostname in dict.fromkeys(hostnames):
+            if hostname:
+                self.pool.submit(self.resolve, hostname)
+
+
+    def _lookup(self, hostname) -> tuple:
+        # (expires at, ip address, error)
+        try:
+            if dns is not None:
+                answer = dns.resolver.resolve(hostname, 'A', lifetime=5)
+                return monotonic() + answer.rrset.ttl, answer[0].to_text(), None
+
+            info = socket.getaddrinfo(hostname, None, socket.AF_INET, socket.SOCK_STREAM)
+            return monotonic() + self.default_ttl, info[0][4][0], None
+
+        except Exception as error:
+            self.logger.warning(f'Could not resolve {hostname}: {error}')
+            return monotonic() + self.failure_ttl, None, f'    X Could not resolve {hostname}: {error}'
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver() -> HostResolver:
+    # The HostResolver shared by every account in the run
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = HostResolver()
+        return _resolver
+
+
 class GoogleDriveAutomation:        
-    def __init__(self) -> None:
+    document_mimetype = 'application/vnd.google-apps.document'
+
+    def __init__(self, index_path='keys/drive_index.sqlite3') -> None:
         self.logger = get_logger(module='GoogleDriveAutomation')
         
         """
-        Opens a tab in your web browser to authenticate use
-        of your Google Account for this python script.
-        Creates two tokens for use later in the script.
+        Nothing is signed in here. The Google credentials and the
+        PyDrive2 client are set up the first time a step needs
+        them, from the tokens saved by earlier runs. A tab only
+        opens in your web browser when no saved token works.
         """
         self.gspread_token_path = 'keys/token_GSpread.json'
         self.pydrive_token_path = 'keys/token_PyDrive.json'
@@ -273,63 +1662,285 @@ class GoogleDriveAutomation:
                         'https://www.googleapis.com/auth/drive.file',
                         'https://www.googleapis.com/auth/drive',
                         'https://www.googleapis.com/auth/gmail.send']
-        
-        # Create token.json for GSpread
-        sys.stdout = open(os.devnull, 'w') # Mutes the spam in the terminal
+        self._credentials = None
+        self._drive = None
+        self._sheets = None
+        self._mail = None
+        self._mail_queue = None
+
+        # Every Drive, Sheets and Gmail call is paced by this
+        self.limiter = get_rate_limiter('google')
+        self.worksheets = {}
+        self.templates = {}
+        self.template_lock = threading.Lock()
+        self.auth_lock = threading.Lock()
+
+        # PyDrive2's http client is not thread safe
+        self.lock = threading.RLock()
+
+        # Set index_path to None to always ask Drive
+        self.index_path = index_path
+        self._index = None
+        self.index_synced = False
+
+
+    @property
+    def credentials(self) -> Credentials:
+        """
+        Google credentials for gspread and Gmail. The saved token
+        is reused while valid and refreshed quietly once expired.
+        """
+        with self.auth_lock:
+            if self._credentials is None or not self._credentials.valid:
+                self._credentials = self._load_credentials()
+            return self._credentials
+
+
+    def _load_credentials(self) -> Credentials:
+        creds = None
+        if os.path.exists(self.gspread_token_path):
+            try:
+                creds = Credentials.from_authorized_user_file(self.gspread_token_path, self.scope)
+            except ValueError:
+                self.logger.warning('The saved Google token is unreadable. Signing in again.')
+
+        if creds and creds.valid:
+            return creds
+
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(GoogleRequest())
+            except GoogleRefreshError as error:
+                self.logger.warning(f'Could not refresh the saved Google token: {error}')
+            else:
+                self._save_credentials(creds)
+                return creds
+
+        # Last resort: ask in the browser
         flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path,
                                                         self.scope)
-        creds = flow.run_local_server(port=0)
+        creds = flow.run_local_server(port=0, authorization_prompt_message=None)
+        self._save_credentials(creds)
+        return creds
+
+
+    def _save_credentials(self, creds) -> None:
         with open(self.gspread_token_path, 'w') as token:
             token.write(creds.to_json())
 
-        # Initialize PyDrive2
-        gauth = GoogleAuth(settings={
-            'client_config_file': self.credentials_path,
-            'save_credentials': True,
-            'save_credentials_backend': 'file',
-            'save_credentials_file': self.pydrive_token_path,
-            'get_refresh_token': True
-        })
-
-        self.drive = GoogleDrive(gauth)
-        sys.stdout = sys.__stdout__ # Unmutes the spam in the terminal
-        
 
-    def download_google_doc(self, document_name, drive_folder_id) -> bool:
-        filename = document_name + ".txt"
+    @property
+    def drive(self) -> GoogleDrive:
+        """
+        The PyDrive2 client, signed in from its saved token (and
+        refreshed if needed) the first time it is used.
+        """
+        with self.auth_lock:
+            if self._drive is None:
+                gauth = GoogleAuth(settings={
+                    'client_config_file': self.credentials_path,
+                    'save_credentials': True,
+                    'save_credentials_backend': 'file',
+                    'save_credentials_file': self.pydrive_token_path,
+                    'get_refresh_token': True
+                })
+                gauth.LoadCredentialsFile(self.pydrive_token_path)
+                if gauth.credentials is None:
+                    gauth.LocalWebserverAuth()
+                elif gauth.access_token_expired:
+                    try:
+                        # Refresh doesn't build the Drive service, Authorize does
+                        gauth.Refresh()
+                        gauth.Authorize()
+                    except RefreshError:
+                        gauth.LocalWebserverAuth()
+                else:
+                    gauth.Authorize()
+                gauth.SaveCredentialsFile(self.pydrive_token_path)
+                self._drive = GoogleDrive(gauth)
+            return self._drive
+
 
-        drive_payload = {'q':  "'" + drive_folder_id + 
-                            "' in parents and trashed=false"}
+    @property
+    def sheets(self) -> gspread.Client:
+        """
+        One gspread client for the whole run. It refreshes its
+        own access token, so there's no need to authorize again.
+        """
+        credentials = self.credentials
+        with self.auth_lock:
+            if self._sheets is None:
+                self._sheets = gspread.authorize(credentials)
+            return self._sheets
         
-        try:
-            drive = self.drive.ListFile(drive_payload).GetList()
-        except RefreshError:
-            os.remove(self.pydrive_token_path)
-            print('Please try to run the script again.')
-            return
 
-        file = [file for file in drive if file['title'] == document_name]
-        try:
-            file_id = file[0]['id']
-        except IndexError:
-            self.logger.error(f'Could not find Google Doc named, "{document_name}".')
-            return False
-            
-        mimetype = file[0]['mimeType']
+    @property
+    def index(self):
+        # The DriveIndex, opened the first time a doc is looked up
+        with self.auth_lock:
+            if self._index is None and self.index_path:
+                self._index = DriveIndex(self.index_path)
+            return self._index
         
-        # Check if it's a folder. Open the folder and repeat the search.
-        if mimetype == "application/vnd.google-apps.folder":
-            self.download_google_doc(document_name=document_name,
-                                        drive_folder_id=file_id)
-            return
+
+    def find_google_doc(self, document_name, drive_folder_id, max_depth=3, batch_size=20):
+        """
+        Asks Drive for the Google Doc named document_name in the
+        folder, matching on title and type in the query itself and
+        asking only for the fields we use, so Sheets, PDFs and
+        other files with the same title are skipped. If it is a
+        folder with that name, the search continues inside it,
+        breadth first and at most max_depth folders deep, with
+        each level's folders batched
+        into as few queries as possible.
+        Returns the file's metadata, or None if it wasn't found.
+        """
+        folder_mimetype = "application/vnd.google-apps.folder"
+        types = f'(mimeType = {drive_quote(self.document_mimetype)} or mimeType = {drive_quote(folder_mimetype)})'
+        level = [drive_folder_id]
+        for _ in range(max_depth + 1):
+            next_level = []
+            for batch in chunks(level, batch_size):
+                parents = ' or '.join(f'{drive_quote(folder_id)} in parents' for folder_id in batch)
+                drive_payload = {'q': f'({parents}) and title = {drive_quote(document_name)} and {types} '
+                                      'and trashed = false',
+                                 'fields': 'items(id, title, mimeType, modifiedDate), nextPageToken'}
+                try:
+                    with self.lock:
+                        files = self.limiter.run(lambda: self.drive.ListFile(drive_payload).GetList())
+                except RefreshError:
+                    os.remove(self.pydrive_token_path)
+                    print('Please try to run the script again.')
+                    return None
+
+                for file in files:
+                    if file['mimeType'] == self.document_mimetype:
+                        return file
+                    # Check if it's a folder. Open the folder and repeat the search.
+                    next_level.append(file['id'])
+
+            if not next_level:
+                break
+            level = next_level
+
+        self.logger.error(f'Could not find Google Doc named, "{document_name}".')
+        return None
+
+
+    def download_google_doc(self, document_name, drive_folder_id) -> bool:
+        file = self.find_google_doc(document_name=document_name,
+                                    drive_folder_id=drive_folder_id)
+        if not file:
+            return False
         
         # Download the file
-        self.drive.CreateFile({'id': file_id}).GetContentFile(filename)
+        with self.lock:
+            self.limiter.run(lambda: self.drive.CreateFile({'id': file['id']}).GetContentFile(document_name + ".txt"))
         return True
+
+
+    def read_google_doc(self, document_name, drive_folder_id):
+        """
+        Exports the Google Doc as plain text straight into memory,
+        without writing a file. Returns the text, or None if the
+        document wasn't found. Documents that haven't changed since
+        the last run come from the Drive index instead.
+        """
+        with self.lock:
+            if self.index and not self.index_synced:
+                self.sync_drive_index()
+
+        entry = self.index.lookup(drive_folder_id, document_name, self.document_mimetype) if self.index else None
+        if entry and entry['text'] is not None:
+            self.logger.info(f'Using the indexed copy of "{document_name}".')
+            return entry['text']
+
+        if entry:
+            file_id, modified = entry['file_id'], entry['modified']
+        else:
+            file = self.find_google_doc(document_name=document_name,
+                                        drive_folder_id=drive_folder_id)
+            if not file:
+                return None
+            file_id, modified = file['id'], file.get('modifiedDate')
+
+        with self.lock:
+            text = self.limiter.run(lambda: self.drive.CreateFile({'id': file_id})
+                                    .GetContentString(mimetype='text/plain', remove_bom=True))
+        if self.index:
+            self.index.store(drive_folder_id, document_name, file_id, modified, text,
+                             mime_type=self.document_mimetype)
+        return text
+
+
+    def sync_drive_index(self) -> None:
+        """
+        Reads the Drive changes feed since the last run and drops
+        every index entry it touches. The first run only records
+        where the feed starts. read_google_doc calls this once
+        before it first uses the index.
+        If Drive can't be asked (an expired page token, say) the
+        index is emptied, the next run starts the feed over, and
+        this run asks Drive for every document.
+        """
+        if not self.index:
+            return
+
+        try:
+            self._sync_drive_index()
+        except Exception:
+            self.logger.exception('Could not sync the Drive index. Not using it for this run.')
+            self.index.clear()
+            self.index.set_setting('changes_page_token', None)
+            with self.auth_lock:
+                self.index_path = None
+                self._index = None
+            return
+        self.index_synced = True
+
+
+    def _sync_drive_index(self) -> None:
+        with self.lock:
+            if self.drive.auth.service is None:
+                self.drive.GetAbout()
+            changes = self.drive.auth.service.changes()
+
+            token = self.index.get_setting('changes_page_token')
+            if not token:
+                self.index.clear()
+                token = self.limiter.run(changes.getStartPageToken().execute)['startPageToken']
+                self.index.set_setting('changes_page_token', token)
+                return
+
+            file_ids = set()
+            folder_titles = set()
+            while True:
+                request = changes.list(pageToken=token, maxResults=1000,
+                                       fields='nextPageToken, newStartPageToken, '
+                                              'items(fileId, file(title, parents(id)))')
+                response = self.limiter.run(request.execute)
+                for change in response.get('items', []):
+                    file_ids.add(change['fileId'])
+                    file = change.get('file') or {}
+                    for parent in file.get('parents', []):
+                        folder_titles.add((parent['id'], file.get('title')))
+
+                if 'newStartPageToken' in response:
+                    token = response['newStartPageToken']
+                    break
+                token = response['nextPageToken']
+
+        self.index.forget(file_ids=file_ids, folder_titles=folder_titles)
+        self.index.set_setting('changes_page_token', token)
+        self.logger.info(f'Drive index synced. {len(file_ids)} file(s) changed since the last run.')
     
 
-    def firewall_rules_spreadsheet(self, folder_id, sheet_id, pbx_hostname, opie_mac_address, opie_ip_address, pms_vendor) -> bool:
-        
+    def firewall_rules_spreadsheet(self, folder_id, sheet_id, pbx_hostname, opie_mac_address, opie_ip_address, pms_vendor,
+                                   pbx_ip_address=None) -> bool:
+        """
+        Fills in the shared firewall rules sheet. pbx_ip_address is
+        what B30 should resolve pbx_hostname to, when it's known.
+        """
         spreadsheet_key = {
             'Full Solution': '1OYVd56jFOnsl0nLd3jVAhuo7z9d553llGFkH4lgdNqI'
         }
@@ -340,60 +1951,196 @@ class GoogleDriveAutomation:
             error = '    X Invalid spreadsheet ID. (Firewall rules skipped!)'
             return False, error
         
-        # Authenticate GSpread
-        creds = Credentials.from_authorized_user_file(self.gspread_token_path,
-                                                      self.scope)
-        client = gspread.authorize(creds)
-
         pms_server_ip = pms_vendor + " Server IP Address"
 
         if ivr_type == 'Full Solution':
-            sheet = client.open_by_key(sheet_id).get_worksheet(0)
-            sheet.update_cell(row=29, col=2, value=pbx_hostname)
-            sheet.update_cell(row=31, col=2, value=opie_mac_address)
-            sheet.update_cell(row=32, col=2, value=opie_ip_address)
-            sheet.update_cell(row=34, col=2, value=pms_server_ip)
-            sleep(2) # Gives the spreadsheet time to convert the hostname to an IP
+            sheet = self.worksheet(sheet_id)
+
+            # B30 still shows the last account's IP until the sheet
+            # has resolved the new hostname
+            old_hostname, old_ip = [cells[0][0] if cells and cells[0] else ''
+                                    for cells in self.limiter.run(lambda: sheet.batch_get(['B29', 'B30']))]
+
+            # All four cells in one request
+            self.limiter.run(lambda: sheet.batch_update([
+                {'range': 'B29', 'values': [[pbx_hostname]]},
+                {'range': 'B31', 'values': [[opie_mac_address]]},
+                {'range': 'B32', 'values': [[opie_ip_address]]},
+                {'range': 'B34', 'values': [[pms_server_ip]]},
+            ], value_input_option='USER_ENTERED'))
+
+            # B30 turns the hostname into an IP, wait until it has. The
+            # same hostname as last time keeps the same IP.
+            stale = old_ip if old_hostname != pbx_hostname else None
+            if not self.wait_for_cell(sheet, 'B30', stale=stale, expected=pbx_ip_address):
+                error = '    X The spreadsheet never resolved the PBX hostname. (Firewall rules skipped!)'
+                return False, error
             return True, None
 
 
-    def download_google_sheet(self, sheet_id, destination_file):
+    def worksheet(self, sheet_id) -> gspread.Worksheet:
+        # Opening a spreadsheet costs a request, so keep it around
+        if sheet_id not in self.worksheets:
+            self.worksheets[sheet_id] = self.limiter.run(lambda: self.sheets.open_by_key(sheet_id).get_worksheet(0))
+        return self.worksheets[sheet_id]
+
+
+    def wait_for_cell(self, sheet, cell, stale=None, expected=None, timeout=None, interval=0.25) -> bool:
+        """
+        Reads cell until its formula has produced a new value,
+        instead of sleeping a fixed amount. The value is new once it
+        equals expected, or differs from stale (what the cell showed
+        before the write). Gives up after timeout seconds (config
+        'sheet_ready_timeout', default 10).
+        """
+        if timeout is None:
+            timeout = float(config.get('sheet_ready_timeout', 10))
+        deadline = monotonic() + timeout
+
+        while True:
+            value = self.limiter.run(lambda: sheet.acell(cell).value)
+            resolved = value and value != 'Loading...' and not value.startswith('#')
+            if resolved and (value == expected or value != stale):
+                return True
+            if monotonic() >= deadline:
+                self.logger.warning(f'{cell} still reads {value!r} after {timeout} seconds.')
+                return False
+            sleep(interval)
+            interval = min(interval * 2, 2)
+
+
+    def firewall_rules_pdf(self, sheet_id, pbx_hostname, pbx_ip_address, opie_mac_address,
+                           opie_ip_address, pms_vendor):
+        """
+        Makes the firewall rules PDF for one account in memory,
+        from the sheet's template read on the first call. Safe
+        to call from many threads at once. The error is a
+        FirewallRulesError when the template has a formula that
+        only the spreadsheet can work out.
+        """
         try:
-            file = self.drive.CreateFile({'id': sheet_id})
+            with self.template_lock:
+                if sheet_id not in self.templates:
+                    sheet = self.worksheet(sheet_id)
+                    self.templates[sheet_id] = self.limiter.run(lambda: FirewallRulesTemplate.from_sheet(sheet))
+            template = self.templates[sheet_id]
+
+            pdf = template.render_pdf(pbx_hostname=pbx_hostname,
+                                      pbx_ip_address=pbx_ip_address,
+                                      opie_mac_address=opie_mac_address,
+                                      opie_ip_address=opie_ip_address,
+                                      pms_server_ip=pms_vendor + " Server IP Address")
+            return pdf, None
+        except Exception as error:
+            return None, error
+
 
-            file.GetContentFile(destination_file, mimetype='application/pdf')
+    def download_google_sheet(self, sheet_id, destination_file):
+        try:
+            with self.lock:
+                file = self.drive.CreateFile({'id': sheet_id})
+                self.limiter.run(lambda: file.GetContentFile(destination_file, mimetype='application/pdf'))
 
             return True, None
         except Exception as error:
             return False, error
     
     
-    def email_with_attachement(self, receiver_emails, subject, body, attachment_path, sender_email=None):
-        if not sender_email:
-            sender_email = config.get('sender_email_address')
+    @property
+    def mail(self):
+        # The MailComposer, set up the first time an email is sent
+        credentials = self.credentials
+        with self.auth_lock:
+            if self._mail is None:
+                self._mail = MailComposer(credentials)
+            return self._mail
+
+
+    def email_with_attachement(self, receiver_emails, subject, body, attachment_path=None, sender_email=None,
+                               attachment=None, attachment_name=None):
+        try:
+            # The attachment is either a file or bytes made in memory.
+            # A file is read a piece at a time while the email is written.
+            if attachment_path:
+                attachment = attachment_path
+                attachment_name = attachment_name or attachment_path
+
+            message = self.mail.compose(receiver_emails=receiver_emails,
+                                        subject=subject,
+                                        body=body,
+                                        attachment=attachment,
+                                        attachment_name=attachment_name,
+                                        sender_email=sender_email)
+            return self.mail.send(message)
+
+        except Exception as error:
+            return False, error
+        
+
+    @property
+    def mail_queue(self):
+        # Emails waiting to be sent together, see MailQueue
+        mail = self.mail
+        with self.auth_lock:
+            if self._mail_queue is None:
+                self._mail_queue = MailQueue(mail, batch_size=int(config.get('mail_batch_size', 20)))
+            return self._mail_queue
 
+
+    def queue_email_with_attachement(self, key, receiver_emails, subject, body, attachment_path=None,
+                                     sender_email=None, attachment=None, attachment_name=None):
+        """
+        Like email_with_attachement, but the email waits in the mail
+        queue and goes out with others in one batch request. The
+        result shows up under key in flush_emails().
+        Returns success, error for putting it in the queue.
+        """
         try:
-            # Authenticate with Gmail API
-            creds = Credentials.from_authorized_user_file(self.gspread_token_path, self.scope)
-            service = build('gmail', 'v1', credentials=creds)
-            
-            # Create recipients string
-            recipients = ', '.join([email for email in receiver_emails if email])
-
-            # Create the email
-            message = MIMEMultipart('mixed')
-            message['to'] = recipients
-            message['from'] = sender_email
-            message['subject'] = subject
-
-            # Create alternative HTML part for the body with inline image
-            msg_related = MIMEMultipart('related')
-            msg_alternative = MIMEMultipart('alternative')
-            msg_related.attach(msg_alternative)
-            message.attach(msg_related)
-
-            # Attach the body with signature, referencing the image by its CID
-            gmail_signature = f"""
+            if attachment_path:
+                attachment = attachment_path
+                attachment_name = attachment_name or attachment_path
+
+            message = self.mail.compose(receiver_emails=receiver_emails,
+                                        subject=subject,
+                                        body=body,
+                                        attachment=attachment,
+                                        attachment_name=attachment_name,
+                                        sender_email=sender_email)
+            self.mail_queue.add(key, message)
+            return True, None
+
+        except Exception as error:
+            return False, error
+
+
+    def flush_emails(self) -> dict:
+        """
+        Sends whatever is still queued. Returns {key: (success, error)}
+        for every queued email, including ones sent earlier when a
+        batch filled up.
+        """
+        if self._mail_queue is None:
+            return {}
+        self._mail_queue.flush()
+        return dict(self._mail_queue.results)
+
+
+class MailComposer:
+    """
+    Builds and sends the emails with the team's signature. The
+    Gmail service and the signature's logo are set up once, so
+    each email only adds its own body and attachment.
+
+    Emails are written to a temporary file (kept in memory up to
+    spool_size bytes) with the attachment base64 encoded a piece
+    at a time. Emails over simple_upload_limit are sent as a
+    resumable upload instead of one base64url string.
+    """
+    spool_size = 5 * 1024 * 1024
+    simple_upload_limit = 5 * 1024 * 1024
+    upload_chunk_size = 1024 * 1024
+    placeholder = b'@@ATTACHMENT@@'
+    signature = """
             <br><br>
             <table>
                 <tr>
@@ -408,43 +2155,510 @@ class GoogleDriveAutomation:
                 </tr>
             </table>
             """
-            body_with_signature = f"{body}{gmail_signature}"
-            msg_alternative.attach(MIMEText(body_with_signature, 'html'))
 
-            # Attach the image as inline content
-            lumistry_logo = 'resources/Lumistry.png'
-            with open(lumistry_logo, 'rb') as img_file:
-                mime_image = MIMEImage(img_file.read())
-                mime_image.add_header('Content-ID', '<signature_image>')
-                mime_image.add_header('Content-Disposition', 'inline', filename="signature_image.png")
-                msg_related.attach(mime_image)
+    def __init__(self, credentials, logo_path='resources/Lumistry.png') -> None:
+        self.credentials = credentials
+        self.service = build('gmail', 'v1', credentials=credentials, cache_discovery=False)
+        self.limiter = get_rate_limiter('google')
 
-            if attachment_path:
-                with open(attachment_path, 'rb') as attachment:
-                    mime_base = MIMEBase('application', 'octet-stream')
-                    mime_base.set_payload(attachment.read())
-                    encoders.encode_base64(mime_base)
-                    mime_base.add_header('Content-Disposition', f'attachment; filename={attachment_path}')
-                    message.attach(mime_base)
+        # httplib2 is not thread safe, so every thread sends with its own
+        self.local = threading.local()
 
-            # Encode the message as a base64url encoded string
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        # The logo is encoded here once and shared by every email
+        with open(logo_path, 'rb') as img_file:
+            self.logo = MIMEImage(img_file.read())
+        self.logo.add_header('Content-ID', '<signature_image>')
+        self.logo.add_header('Content-Disposition', 'inline', filename="signature_image.png")
 
-            # Create the message object
-            message_object = {'raw': raw_message}
 
-            # Send the email
-            service.users().messages().send(userId="me", body=message_object).execute()
-            return True, None
+    def compose(self, receiver_emails, subject, body, attachment=None, attachment_name=None,
+                sender_email=None) -> SpooledTemporaryFile:
+        """
+        Writes the email to a temporary file, ready for send() or
+        request(). attachment is bytes, a file path or an open
+        binary file.
+        """
+        if not sender_email:
+            sender_email = config.get('sender_email_address')
 
+        # Create the email
+        message = MIMEMultipart('mixed')
+        message['to'] = ', '.join([email for email in receiver_emails if email])
+        message['from'] = sender_email
+        message['subject'] = subject
+
+        # HTML body with the signature, which shows the logo by its CID
+        msg_related = MIMEMultipart('related')
+        msg_alternative = MIMEMultipart('alternative')
+        msg_related.attach(msg_alternative)
+        msg_alternative.attach(MIMEText(f"{body}{self.signature}", 'html'))
+        msg_related.attach(self.logo)
+        message.attach(msg_related)
+
+        # The attachment's part only holds a placeholder, its
+        # content is encoded straight into the file in its place
+        if attachment is not None:
+            mime_base = MIMEBase('application', 'octet-stream')
+            mime_base['Content-Transfer-Encoding'] = 'base64'
+            mime_base.add_header('Content-Disposition', 'attachment', filename=attachment_name)
+            mime_base.set_payload(self.placeholder.decode())
+            message.attach(mime_base)
+
+        head, _, tail = message.as_bytes().partition(self.placeholder)
+        spool = SpooledTemporaryFile(max_size=self.spool_size)
+        spool.write(head)
+        if attachment is not None:
+            self._write_base64(spool, attachment)
+        spool.write(tail)
+        spool.seek(0)
+        return spool
+
+
+    def _write_base64(self, spool, attachment) -> None:
+        if isinstance(attachment, (bytes, bytearray)):
+            source = io.BytesIO(attachment)
+        elif isinstance(attachment, str):
+            source = open(attachment, 'rb')
+        else:
+            source = attachment
+
+        try:
+            # 57 bytes make one 76 character line
+            while True:
+                data = source.read(57 * 1024)
+                if not data:
+                    break
+                spool.write(base64.encodebytes(data))
+        finally:
+            if source is not attachment:
+                source.close()
+
+
+    def send(self, message):
+        # Returns success, error
+        try:
+            self.limiter.run(lambda: self.request(message).execute(http=self.http()), idempotent=False)
+            return True, None
         except Exception as error:
             return False, error
-        
+        finally:
+            message.close()
 
-class CalCom:
+
+    def request(self, message):
+        """
+        The Gmail send request for a composed message, not yet
+        executed. Large messages are uploaded in chunks rather
+        than read into memory, so they can't go in a batch.
+        """
+        message.seek(0)
+        if self.is_large(message):
+            media = MediaIoBaseUpload(message, mimetype='message/rfc822',
+                                      chunksize=self.upload_chunk_size, resumable=True)
+            return self.service.users().messages().send(userId="me", body={}, media_body=media)
+
+        raw_message = base64.urlsafe_b64encode(message.read()).decode()
+        return self.service.users().messages().send(userId="me", body={'raw': raw_message})
+
+
+    def is_large(self, message) -> bool:
+        position = message.tell()
+        message.seek(0, io.SEEK_END)
+        size = message.tell()
+        message.seek(position)
+        return size > self.simple_upload_limit
+
+
+    def http(self) -> AuthorizedHttp:
+        if getattr(self.local, 'http', None) is None:
+            self.local.http = AuthorizedHttp(self.credentials, http=Http(timeout=60))
+        return self.local.http
+
+
+class MailQueue:
+    """
+    Holds composed emails and sends them batch_size at a time in
+    one Gmail batch request. Emails Gmail turned away (rate limit,
+    or 503 with Retry-After) are sent again, up to retries times,
+    with a growing wait in between. Anything else, including a
+    dropped connection, is reported as failed rather than risk
+    sending an email twice. Results are kept per key.
+    """
+    def __init__(self, composer, batch_size=20, retries=3) -> None:
+        self.logger = get_logger(module='MailQueue')
+        self.composer = composer
+        self.batch_size = batch_size
+        self.retries = retries
+        self.pending = []
+        self.results = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, key, message) -> None:
+        # Large emails can't be batched, they go out right away
+        if self.composer.is_large(message):
+            result = self.composer.send(message)
+            with self.lock:
+                self.results[key] = result
+            return
+
+        # Sends the queue once it holds a full batch
+        with self.lock:
+            self.pending.append((key, message))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+
+    def flush(self) -> dict:
+        # Sends everything queued so far. Returns {key: (success, error)}
+        with self.lock:
+            queued, self.pending = self.pending, []
+
+        results = {}
+        for batch in chunks(queued, self.batch_size):
+            try:
+                results.update(self._send_batch(batch))
+            finally:
+                for _, message in batch:
+                    message.close()
+
+        with self.lock:
+            self.results.update(results)
+        return results
+
+
+    def _send_batch(self, batch) -> dict:
+        results = {}
+        waiting = {str(number): item for number, item in enumerate(batch)}
+        limiter = self.composer.limiter
+
+        for attempt in range(self.retries + 1):
+            retry = {}
+
+            def callback(request_id, response, exception):
+                key = waiting[request_id][0]
+                if exception is None:
+                    results[key] = (True, None)
+                elif self._refused(exception) and attempt < self.retries:
+                    retry[request_id] = waiting[request_id]
+                else:
+                    results[key] = (False, exception)
+
+            request = self.composer.service.new_batch_http_request(callback=callback)
+            for request_id, (key, message) in waiting.items():
+                request.add(self.composer.request(message), request_id=request_id)
+
+            try:
+                with limiter.slot():
+                    request.execute(http=self.composer.http())
+            except Exception as error:
+                # Only a refused batch is sure not to have sent anything.
+                # After a timeout or dropped connection some emails may
+                # have gone out, so none are sent again.
+                if not self._refused(error) or attempt == self.retries:
+                    for request_id, (key, _) in waiting.items():
+                        results.setdefault(key, (False, error))
+                    return results
+                retry = {request_id: item for request_id, item in waiting.items()
+                         if item[0] not in results}
+
+            if not retry:
+                break
+            self.logger.warning(f'Sending {len(retry)} email(s) again (attempt {attempt + 2})')
+            limiter.throttled(limiter.backoff(attempt))
+            waiting = retry
+
+        return results
+
+
+    def _refused(self, error) -> bool:
+        # Gmail turned the request away (rate limited), so it wasn't sent
+        status, retry_after = RateLimiter._error_status(error)
+        if isinstance(error, (OSError, TimeoutError)):
+            return False
+        return self.composer.limiter.retryable(status, error, idempotent=False, retry_after=retry_after)
+
+
+class KeyedLocks:
+    """
+    One lock per key, so work on different keys runs in parallel
+    while work on the same key waits its turn. A key's lock is
+    dropped again once nobody holds or waits for it.
+    """
     def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.locks = {}
+
+
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+
+class SlotCache:
+    """
+    Remembers the open Cal.com slots of each event type for ttl
+    seconds, so pharmacies with the same event type share one
+    download. Slots are kept as UTC datetimes.
+    """
+    def __init__(self, ttl=300) -> None:
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.key_locks = KeyedLocks()
+
+
+    def get(self, key, fetch, duration=None) -> list:
+        """
+        duration is the event type's length as a timedelta. It's
+        kept with the slots so a booking can drop the ones it overlaps.
+        """
+        with self.key_locks.hold(key):
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is None or monotonic() - entry[0] > self.ttl:
+                entry = (monotonic(), set(fetch()), duration)
+                with self.lock:
+                    self.entries[key] = entry
+        with self.lock:
+            return sorted(entry[1])
+
+    def invalidate(self, start: datetime, end: datetime) -> None:
+        """
+        Drops every cached slot that overlaps a booking. The installers
+        are shared between event types, so a 2 hour booking also takes
+        out the 30 minute slots inside it, and the longer slots that
+        start before it and run into it.
+        """
+        start = start.astimezone(dt_timezone.utc)
+        end = end.astimezone(dt_timezone.utc)
+        with self.lock:
+            for _, slots, duration in self.entries.values():
+                # Unknown length, assume it's as long as the booking
+                length = duration or (end - start)
+                for slot in [s for s in slots if s < end and s + length > start]:
+                    slots.discard(slot)
+
+# Shared by every CalCom instance
+shared_slot_cache = SlotCache()
+
+
+def parse_date(value):
+    """
+    Reads a date the way reports and exports write them
+    (2024-05-14, 5/14/2024, 5/14/24). Returns None if it can't.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for date_format in ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y'):
+        try:
+            return datetime.strptime(str(value).strip(), date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def time_to_minutes(value: str) -> int:
+    # '13:30:00' -> 810
+    hours, minutes = value.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+class SlotIndex:
+    """
+    The open slots of each day as sorted minutes after midnight,
+    so a preferred time is matched with a binary search instead
+    of parsing every slot again. A day is indexed the first time
+    it is looked at.
+    """
+    def __init__(self, available_slots: dict) -> None:
+        self.available_slots = available_slots
+        self.days = {}
+
+
+    def __contains__(self, day) -> bool:
+        return day in self.available_slots
+
+
+    def day(self, day):
+        # (sorted minutes, {minutes: 'HH:MM:SS'}) for one day
+        indexed = self.days.get(day)
+        if indexed is None:
+            labels = {}
+            for slot_time in self.available_slots.get(day, ()):
+                labels.setdefault(time_to_minutes(slot_time), slot_time)
+            indexed = self.days[day] = (sorted(labels), labels)
+        return indexed
+
+
+    def exact(self, day, minutes: int):
+        # The slot at exactly this time, or None
+        return self.day(day)[1].get(minutes)
+
+
+    def between(self, day, first: int, last: int) -> list:
+        # [(minutes, 'HH:MM:SS')] of the slots from first through last minutes, in order
+        day_minutes, labels = self.day(day)
+        start = bisect.bisect_left(day_minutes, first)
+        stop = bisect.bisect_right(day_minutes, last)
+        return [(minutes, labels[minutes]) for minutes in day_minutes[start:stop]]
+
+
+    def next_within(self, day, minutes: int, window=120):
+        # The first slot after this time and no more than window minutes later, or None
+        found = self.between(day, minutes + 1, minutes + window)
+        return found[0][1] if found else None
+
+
+def match_slot(preferred_dates: list, preferred_times: list, slot_index: SlotIndex):
+    """
+    Goes through the preferred days in order, and for each day the
+    preferred times in order. Returns the first of:
+        'Perfect Match', {'day', 'time'} - the preferred time is open
+        'Close Enough', {'day', 'time'}  - a slot within 2 hours after it is open
+    or 'Nothing', None when no preference can be met.
+    """
+    preferred_minutes = [time_to_minutes(pref_time) for pref_time in preferred_times or []]
+    for day in preferred_dates:
+        if day not in slot_index:
+            continue  # Skip if the preferred day is not available
+
+        for minutes in preferred_minutes:
+            slot_time = slot_index.exact(day, minutes)
+            if slot_time:
+                return 'Perfect Match', {'day': day, 'time': slot_time}
+
+            slot_time = slot_index.next_within(day, minutes)
+            if slot_time:
+                return 'Close Enough', {'day': day, 'time': slot_time}
+
+    return 'Nothing', None
+
+
+def _overlaps(booked: list, start, end) -> bool:
+    # True if [start, end) overlaps one of booked, a sorted list of non-overlapping (start, end)
+    position = bisect.bisect_left(booked, (end,))
+    return position > 0 and booked[position - 1][1] > start
+
+
+def _shortest_augmenting_path(edges, starts, match_left, match_right, potential):
+    """
+    One round of min_cost_assignment: a Dijkstra search from the
+    left nodes in starts to the nearest unpaired right node, over
+    costs kept >= 0 by the potentials. Pairs along the cheapest path
+    are flipped and the potentials updated. Returns False when no
+    unpaired right node can be reached.
+    """
+    source = ('S', None)
+    dist = {source: 0}
+    parent = {}
+    done = set()
+    heap = [(0, 0, source)]
+    counter = 1
+    target = None
+
+    while heap:
+        d, _, node = heapq.heappop(heap)
+        if node in done:
+            continue
+        done.add(node)
+        side, name = node
+
+        if side == 'R' and name not in match_right:
+            target = node
+            break
+
+        if side == 'S':
+            neighbors = [(('L', left), 0) for left in starts]
+        elif side == 'L':
+            neighbors = ((('R', right), cost) for right, cost in edges[name].items()
+                         if match_left.get(name) != right)
+        else:
+            left = match_right[name]
+            neighbors = [(('L', left), -edges[left][name])]
+
+        for neighbor, cost in neighbors:
+            if neighbor in done:
+                continue
+            reduced = cost + potential.get(node, 0) - potential.get(neighbor, 0)
+            if d + reduced < dist.get(neighbor, float('inf')):
+                dist[neighbor] = d + reduced
+                parent[neighbor] = node
+                heapq.heappush(heap, (d + reduced, counter, neighbor))
+                counter += 1
+
+    if target is None:
+        return False
+
+    # Keep every reduced cost >= 0 for the next search
+    limit = dist[target]
+    for node in done:
+        potential[node] = potential.get(node, 0) + dist[node] - limit
+
+    # Flip the paired and unpaired edges along the path
+    node = target
+    while parent[node] != source:
+        previous = parent[node]
+        if node[0] == 'R':
+            match_left[previous[1]] = node[1]
+            match_right[node[1]] = previous[1]
+        node = previous
+    return True
+
+
+def min_cost_assignment(edges: dict) -> dict:
+    """
+    Pairs left nodes with right nodes: as many pairs as possible,
+    at the lowest total cost. edges is sparse, {left: {right: cost}}
+    with integer costs >= 0, listing only the allowed pairs.
+    Returns {left: right}.
+
+    This is min-cost flow by successive shortest paths with node
+    potentials, so the work grows with the number of edges rather
+    than with rows x columns like a dense Hungarian matrix.
+
+    The fast pass adds one left node at a time, searching only from
+    that node. When every left node gets paired the result is
+    optimal. If some can't be paired, which pairs to drop matters,
+    so the search is redone from all unpaired left nodes together.
+    """
+    match_left, match_right, potential = {}, {}, {}
+    for left in edges:
+        _shortest_augmenting_path(edges, [left], match_left, match_right, potential)
+    if len(match_left) == len(edges):
+        return match_left
+
+    match_left, match_right, potential = {}, {}, {}
+    while _shortest_augmenting_path(edges, [left for left in edges if left not in match_left],
+                                    match_left, match_right, potential):
+        pass
+    return match_left
+
+
+class CalCom:
+    # Used when Cal.com won't say how long an event type is
+    default_event_length = timedelta(minutes=30)
+
+    def __init__(self, slot_cache=None) -> None:
         self.logger = get_logger(module='CalCom')
         self.base_url = 'https://api.cal.com/v1/'
+        self.session = get_transport().session(self.base_url)
+        self.slot_cache = slot_cache or shared_slot_cache
+        self.event_lengths = {}
 
         self.today = date.today()
         self.first_week = self.today.isocalendar()[1]
@@ -489,28 +2703,77 @@ class CalCom:
 
 
     def get_event_slots(self, event_id: int, start_date: datetime, timezone: str) -> dict:
-        payload = {"eventTypeId": event_id, # Integer
-                    "startTime": start_date, # DateTime
-                    "endTime": self.third_friday, # DateTime
-                    "timeZone": timezone} # US/Eastern
-        response = requests.get(f'{self.base_url}slots?apiKey={self.api_key}', 
-                                params=payload)
-        data = response.json()
+        """
+        Open install slots from start_date through third_friday,
+        shown in the customer's timezone:
+        {'2024-05-14': ['08:00:00', '09:00:00'], ...}
+        Slots come from the shared slot cache, which downloads
+        each event type once per TTL for every pharmacy.
+        """
+        slots = self.cached_slots(event_id)
+
+        first_day = parse_date(start_date)
+        if first_day is None:
+            self.logger.warning(f'Could not read start date "{start_date}". Showing every open slot.')
 
         # Create a new dictionary to store cleaned data
         cleaned_data = {}
+        tz = pytz.timezone(timezone)
+        for slot in slots:
+            local_slot = slot.astimezone(tz)
+            if first_day and local_slot.date() < first_day:
+                continue
+            cleaned_data.setdefault(local_slot.strftime('%Y-%m-%d'), []).append(local_slot.strftime('%H:%M:%S'))
 
-        # Iterate through the original data and restructure it
-        for listed_date, times in data['slots'].items():
-            cleaned_times = []
-            for time_data in times:
-                # Extract time using regular expression
-                time_match = time_data['time'].split("T")[1].split("-")[0]
-                cleaned_times.append(time_match)
-
-            cleaned_data[listed_date] = cleaned_times
         self.logger.info(f'Available times to install in {timezone}: {cleaned_data}')
         return cleaned_data
+
+
+    def fetch_event_slots(self, event_id: int) -> list:
+        # Downloads every open slot from today through third_friday as UTC datetimes
+        payload = {"eventTypeId": event_id, # Integer
+                    "startTime": self.today, # DateTime
+                    "endTime": self.third_friday, # DateTime
+                    "timeZone": 'UTC'}
+        response = self.session.get(f'{self.base_url}slots?apiKey={self.api_key}', 
+                                    params=payload)
+        data = response.json() if response.status_code == 200 else {}
+        if 'slots' not in data:
+            # Only the pharmacies of this event type go without a slot
+            self.logger.error(f'Status {response.status_code} when getting open slots for event type {event_id}')
+            self.logger.error(response.content)
+            return []
+
+        slots = []
+        for times in data['slots'].values():
+            for time_data in times:
+                slot = datetime.fromisoformat(time_data['time'].replace('Z', '+00:00'))
+                slots.append(slot.astimezone(dt_timezone.utc))
+
+        self.logger.info(f'Downloaded {len(slots)} open slots for event type {event_id}')
+        return slots
+
+
+    def event_length(self, event_id: int):
+        # Length of an event type as a timedelta, None if Cal.com won't say
+        if event_id not in self.event_lengths:
+            response = self.session.get(f'{self.base_url}event-types/{event_id}?apiKey={self.api_key}')
+            length = None
+            if response.status_code == 200:
+                minutes = response.json().get('event_type', {}).get('length')
+                if minutes:
+                    length = timedelta(minutes=int(minutes))
+            else:
+                self.logger.warning(f'Status {response.status_code} when looking up the length of event type {event_id}')
+            self.event_lengths[event_id] = length
+        return self.event_lengths[event_id]
+
+
+    def cached_slots(self, event_id: int) -> list:
+        # Open slots for an event type, shared between pharmacies through the slot cache
+        return self.slot_cache.get((event_id, self.third_friday),
+                                   lambda: self.fetch_event_slots(event_id=event_id),
+                                   duration=self.event_length(event_id))
         
     
     def convert_timezone(self, timezone: str):
@@ -569,9 +2832,9 @@ class CalCom:
 
     def get_first_available(self, avail_slots: dict) -> str:
         for day, times in avail_slots.items():
-            for time in times:
-                if time >= '08:00:00':
-                    return {'day': day, 'time': time}
+            for slot_time in times:
+                if slot_time >= '08:00:00':
+                    return {'day': day, 'time': slot_time}
         
         self.logger.critical('No available install slots were found in the next week!')
         return 
@@ -582,37 +2845,146 @@ class CalCom:
         self.logger.info(f'Customer\'s preferred dates: {preferred_dates}')
         self.logger.info(f'Customer\'s preferred times: {preferred_times}')
         
-        for day in preferred_dates:
-            if day not in available_slots:
-                continue  # Skip if the preferred day is not available
-            
-            for pref_time in preferred_times:
-                if pref_time in available_slots[day]:  # Perfect match
-                    self.logger.info(f'Found a perfect match on {day} at {pref_time}')
-                    return 'Perfect Match', {'day': day, 'time': pref_time}
-
-                # Get within 2 hours of their preference
-                pref_time_obj = datetime.strptime(pref_time, '%H:%M:%S')
-                closest_time = None
-                min_difference = float('inf')
-
-                for avail_time in available_slots[day]:
-                    avail_time_obj = datetime.strptime(avail_time, '%H:%M:%S')
-                    difference = (avail_time_obj - pref_time_obj).total_seconds()
-
-                    if 0 < difference <= 7200 and difference < min_difference:  # within 2 hours
-                        closest_time = avail_time
-                        min_difference = difference
-                
-                if closest_time:
-                    self.logger.info(f'Matched customer\'s preferred day ({day}), but compromised on time ({closest_time})')
-                    return 'Close Enough', {'day': day, 'time': closest_time}
+        result, slot = match_slot(preferred_dates=preferred_dates,
+                                  preferred_times=preferred_times,
+                                  slot_index=SlotIndex(available_slots))
+        if result == 'Perfect Match':
+            self.logger.info(f'Found a perfect match on {slot["day"]} at {slot["time"]}')
+            return result, slot
+        if result == 'Close Enough':
+            self.logger.info(f'Matched customer\'s preferred day ({slot["day"]}), but compromised on time ({slot["time"]})')
+            return result, slot
         
         self.logger.warning('Did not match their preferred time to an available slot. Scheduling first available slot!')
         first_available = self.get_first_available(available_slots)
         return 'Nothing', first_available
     
 
+    def assign_slots(self, install_requests: list, max_candidates=30, fallback_candidates=10) -> dict:
+        """
+        Picks install slots for every pharmacy of the run together,
+        so one pharmacy can't take the only good slot of another and
+        no two installs overlap. Each request is a dict with:
+            'key', 'event_id', 'timezone', 'start_date',
+            'preferred_dates', 'preferred_times'
+        with preferred_times None for "First Available".
+
+        Perfect Match slots cost the least, then Close Enough ones
+        (within 2 hours after), then the first available slots, and
+        earlier preferences cost less than later ones. The cheapest
+        assignment over the shared slot pool is found with
+        min_cost_assignment. To keep that fast each pharmacy only
+        offers its max_candidates best and fallback_candidates
+        first slots, so pharmacies it leaves out are then given the
+        first free slot they can take, until the slots run out.
+
+        The installers are shared between event types, so a slot is
+        taken for as long as its event type lasts. Picks that overlap
+        one another are dropped, cheapest first kept, and the
+        pharmacies that lost theirs are assigned again from the slots
+        that are still free.
+
+        Returns {key: (result, {'day': ..., 'time': ...})} where
+        result is 'Perfect Match', 'Close Enough', 'Nothing' or
+        'First Available'. Keys that got no slot are left out.
+        """
+        perfect, close, fallback = 0, 10_000_000, 100_000_000
+        edges = {}
+        labels = {}
+        timezones = {}
+        lengths = {}
+        pools = {}
+
+        for request in install_requests:
+            key = request['key']
+            slots = self.cached_slots(request['event_id'])
+            tz = pytz.timezone(request['timezone'])
+            first_day = parse_date(request['start_date'])
+
+            # The pharmacy's view of the pool, and which UTC slot each local time is
+            local_slots = {}
+            utc_slots = {}
+            for slot in slots:
+                local_slot = slot.astimezone(tz)
+                if first_day and local_slot.date() < first_day:
+                    continue
+                day, slot_time = local_slot.strftime('%Y-%m-%d'), local_slot.strftime('%H:%M:%S')
+                local_slots.setdefault(day, []).append(slot_time)
+                utc_slots.setdefault((day, slot_time), slot)
+            slot_index = SlotIndex(local_slots)
+
+            candidates = {}
+            preferred_times = request['preferred_times']
+            if preferred_times is not None:
+                preferred_minutes = [time_to_minutes(pref_time) for pref_time in preferred_times]
+                for day_rank, day in enumerate(request['preferred_dates']):
+                    if day not in slot_index:
+                        continue
+                    for time_rank, minutes in enumerate(preferred_minutes):
+                        rank = (day_rank * len(preferred_minutes) + time_rank) * 200
+                        for slot_minutes, slot_time in slot_index.between(day, minutes, minutes + 120):
+                            slot = utc_slots[(day, slot_time)]
+                            difference = slot_minutes - minutes
+                            cost = perfect + rank if difference == 0 else close + rank + difference
+                            if cost < candidates.get(slot, (fallback * 2,))[0]:
+                                candidates[slot] = (cost, 'Perfect Match' if difference == 0 else 'Close Enough')
+
+                candidates = dict(sorted(candidates.items(), key=lambda item: item[1][0])[:max_candidates])
+
+            # Always allow the first available slots, so everyone gets something
+            fallback_result = 'First Available' if preferred_times is None else 'Nothing'
+            first_slots = [utc_slots[(day, slot_time)]
+                           for day in sorted(local_slots)
+                           for _, slot_time in slot_index.between(day, 8 * 60, 24 * 60)]
+            for position, slot in enumerate(first_slots[:fallback_candidates]):
+                candidates.setdefault(slot, (fallback + position, fallback_result))
+
+            edges[key] = {slot: cost for slot, (cost, _) in candidates.items()}
+            labels[key] = {slot: result for slot, (_, result) in candidates.items()}
+            timezones[key] = tz
+            lengths[key] = self.event_length(request['event_id']) or self.default_event_length
+            pools[key] = first_slots
+
+        # Keep the picks that don't overlap, cheapest first, and assign
+        # the rest again from what's still free until nothing conflicts
+        assignment = {}
+        booked = []
+        while edges:
+            picks = min_cost_assignment(edges)
+            if not picks:
+                break
+            for key, slot in sorted(picks.items(), key=lambda pick: edges[pick[0]][pick[1]]):
+                if not _overlaps(booked, slot, slot + lengths[key]):
+                    bisect.insort(booked, (slot, slot + lengths[key]))
+                    assignment[key] = slot
+            edges = {key: {slot: cost for slot, cost in slot_costs.items()
+                           if not _overlaps(booked, slot, slot + lengths[key])}
+                     for key, slot_costs in edges.items() if key not in assignment}
+            edges = {key: slot_costs for key, slot_costs in edges.items() if slot_costs}
+
+        # Everyone left out gets the first free slot from 8 AM on
+        for request in install_requests:
+            key = request['key']
+            if key in assignment:
+                continue
+            fallback_result = 'First Available' if request['preferred_times'] is None else 'Nothing'
+            for slot in pools[key]:
+                if not _overlaps(booked, slot, slot + lengths[key]):
+                    bisect.insort(booked, (slot, slot + lengths[key]))
+                    assignment[key] = slot
+                    labels[key][slot] = fallback_result
+                    break
+
+        self.logger.info(f'Assigned slots to {len(assignment)} of {len(install_requests)} pharmacies.')
+
+        results = {}
+        for key, slot in assignment.items():
+            local_slot = slot.astimezone(timezones[key])
+            results[key] = (labels[key][slot], {'day': local_slot.strftime('%Y-%m-%d'),
+                                                'time': local_slot.strftime('%H:%M:%S')})
+        return results
+
+
     def combine_day_time(self, day_time: dict, timezone) -> str:
         #Put the start date and start time together in one string
         date_obj = datetime.strptime(day_time.get('day'), '%Y-%m-%d')
@@ -643,12 +3015,18 @@ class CalCom:
                     }
 
         url = self.base_url + 'bookings?apiKey=' + self.api_key
-        response = requests.post(url, json=payload)
+        response = self.session.post(url, json=payload)
 
         if response.status_code == 200:
             response_json = response.json()
             uid = response_json.get('uid')
             reschedule_link = 'https://cal.com/reschedule/' + uid
+            start = datetime.strptime(event_slot, "%Y-%m-%dT%H:%M:%S%z")
+            if response_json.get('endTime'):
+                end = datetime.fromisoformat(response_json['endTime'].replace('Z', '+00:00'))
+            else:
+                end = start + (self.event_length(event_id) or self.default_event_length)
+            self.slot_cache.invalidate(start, end)
             return True, reschedule_link
         else:
             self.logger.error(f'Status {response.status_code} when scheduling install.')
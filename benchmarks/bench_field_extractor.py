@@ -0,0 +1,88 @@
+"""
+Compares FieldExtractor against the line-by-line substring tests
+process_google_doc used to run, on large intake documents.
+
+Run from the root folder of this project:
+    python benchmarks/bench_field_extractor.py
+"""
+import os
+import random
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from automation_library import FieldExtractor
+
+
+fields = {
+    'local_ip_scheme': ('IP Address:', ('Pharmacy', 'Public')),
+    'pms_vendor': 'Pharmacy Software Vendor',
+    'contact_work_number': 'Primary Work Phone',
+    'contact_phone_number': 'Primary Cell Phone',
+    'it_contact_name': 'IT Contact Name',
+    'it_contact_email': 'IT Contact Email'
+}
+
+field_lines = ['Pharmacy IP Address: 203.0.113.5',
+               'Public IP Address: 203.0.113.6',
+               'Local IP Address: 192.168.1.10',
+               'Pharmacy Software Vendor: PioneerRx',
+               'Primary Work Phone: 8645550100',
+               'Primary Cell Phone: 8645550101',
+               'IT Contact Name: Pat Smith',
+               'IT Contact Email: pat@example.com']
+
+
+def old_scan(document_text):
+    # The scanning loop as it was before FieldExtractor
+    found = {}
+    for line in document_text.splitlines():
+        if 'IP Address:' in line and 'Pharmacy' not in line and 'Public' not in line:
+            found['local_ip_scheme'] = line.split(':')[1].strip()
+        if 'Pharmacy Software Vendor' in line:
+            found['pms_vendor'] = line.split(':')[1].strip()
+        if 'Primary Work Phone' in line:
+            found['contact_work_number'] = line.split(':')[1].strip()
+        if 'Primary Cell Phone' in line:
+            found['contact_phone_number'] = line.split(':')[1].strip()
+        if 'IT Contact Name' in line:
+            found['it_contact_name'] = line.split(':')[1].strip()
+        if 'IT Contact Email' in line:
+            found['it_contact_email'] = line.split(':')[1].strip()
+    return {name: found.get(name) for name in fields}
+
+
+def make_document(lines, field_position):
+    # Filler text with the intake fields placed at field_position (0 to 1) of the document
+    filler = [f'Note {number}: ' + ' '.join(random.choice(['phone', 'fax', 'router', 'switch', 'hours', 'staff'])
+                                             for _ in range(12))
+              for number in range(lines)]
+    at = int(lines * field_position)
+    return '\n'.join(filler[:at] + field_lines + filler[at:])
+
+
+def main():
+    random.seed(1)
+    extractor = FieldExtractor(fields)
+    cases = {
+        'fields near the top': make_document(lines=20000, field_position=0.05),
+        'fields in the middle': make_document(lines=20000, field_position=0.5),
+        'fields at the end': make_document(lines=20000, field_position=1),
+        'field repeated later': make_document(lines=20000, field_position=0.05)
+                                + '\nPharmacy Software Vendor: Liberty',
+        'ignored line repeated': make_document(lines=20000, field_position=0.05)
+                                 + '\nPublic IP Address: 198.51.100.7',
+    }
+
+    runs = 10
+    for name, document in cases.items():
+        assert extractor.extract(document) == old_scan(document)
+        assert extractor.extract(document.splitlines()) == old_scan(document)
+
+        old = timeit(lambda: old_scan(document), number=runs) / runs
+        new = timeit(lambda: extractor.extract(document), number=runs) / runs
+        print(f'{name:22s} old {old * 1000:8.2f} ms   new {new * 1000:8.2f} ms   {old / new:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Compares match_slot against the nested-loop matching that
+CalCom.compare_pref_to_available used to do, on a large slot grid.
+
+Run from the root folder of this project:
+    python benchmarks/bench_slot_matching.py
+"""
+import os
+import random
+import sys
+from datetime import date, datetime, timedelta
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from automation_library import SlotIndex, match_slot
+
+
+def old_compare(preferred_dates, preferred_times, available_slots):
+    # The matching loop as it was before SlotIndex
+    for day in preferred_dates:
+        if day not in available_slots:
+            continue
+
+        for pref_time in preferred_times:
+            if pref_time in available_slots[day]:
+                return 'Perfect Match', {'day': day, 'time': pref_time}
+
+            pref_time_obj = datetime.strptime(pref_time, '%H:%M:%S')
+            closest_time = None
+            min_difference = float('inf')
+
+            for avail_time in available_slots[day]:
+                avail_time_obj = datetime.strptime(avail_time, '%H:%M:%S')
+                difference = (avail_time_obj - pref_time_obj).total_seconds()
+
+                if 0 < difference <= 7200 and difference < min_difference:
+                    closest_time = avail_time
+                    min_difference = difference
+
+            if closest_time:
+                return 'Close Enough', {'day': day, 'time': closest_time}
+
+    return 'Nothing', None
+
+
+def make_grid(days, step_minutes, fill, first_hour=6, last_hour=20):
+    # Slots every step_minutes between the two hours, with roughly fill of them open
+    start = date(2024, 5, 13)
+    grid = {}
+    for offset in range(days):
+        day = (start + timedelta(days=offset)).strftime('%Y-%m-%d')
+        grid[day] = [f'{minutes // 60:02d}:{minutes % 60:02d}:00'
+                     for minutes in range(first_hour * 60, last_hour * 60, step_minutes)
+                     if random.random() < fill]
+    return grid
+
+
+def main():
+    random.seed(1)
+    morning_times = [f'{hour:02d}:{minute:02d}:00' for hour in range(8, 12) for minute in (0, 15, 30, 45)]
+    cases = {
+        # Preferences that match early on
+        'dense grid, early match': (make_grid(days=30, step_minutes=5, fill=0.3), morning_times),
+        # Only afternoons are open, so every morning preference is tried and missed
+        'afternoons only, no match': (make_grid(days=30, step_minutes=5, fill=0.9, first_hour=14), morning_times),
+        # A lot of open slots a day and one unreachable preference
+        'huge grid, no match': (make_grid(days=30, step_minutes=1, fill=0.9, first_hour=14), ['05:00:00']),
+    }
+
+    runs = 20
+    for name, (grid, times) in cases.items():
+        dates = sorted(grid)[::3]
+        assert match_slot(dates, times, SlotIndex(grid)) == old_compare(dates, times, grid)
+
+        old = timeit(lambda: old_compare(dates, times, grid), number=runs) / runs
+        new = timeit(lambda: match_slot(dates, times, SlotIndex(grid)), number=runs) / runs
+        print(f'{name:28s} {len(dates):3d} days x {len(times):3d} times: '
+              f'old {old * 1000:8.3f} ms   new {new * 1000:8.3f} ms   {old / new:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,24 @@ The primary goals of this script are:
     3. Communicate with the customer and my team members
 """
 import os
-from automation_library import get_logger, CredentialsManager, SalesForceAutomation, GoogleDriveAutomation, CalCom
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from automation_library import get_logger, log_account, chunks, CredentialsManager, FieldExtractor, ReportError, SalesForceAutomation, GoogleDriveAutomation, CalCom, get_resolver, FirewallRulesError, BudgetExceeded, check_api_budget
 
 # SalesForce Report to pull
 report_id = '00O4v000008E412EAC'    # Shipped/Arrived Report
 
+# The same report written as SOQL, with report_columns mapping its
+# fields to the report's column labels, e.g.
+#     report_columns = {'Name': 'Account Update', 'Account__r.Name': 'Account Name'}
+# When it has more than bulk_threshold rows it is exported through the
+# Bulk API instead. Left off (None) until the report's real filters
+# are written here; the report is then always read with the Reports API.
+report_query = None
+report_columns = {}
+bulk_threshold = 2000
+
 # IVR Type - this must be exactly as the report lists it
 project_type = 'VOW Full'
 
@@ -21,47 +34,94 @@ project_type = 'VOW Full'
 firewall_rules_folder_id = '1l5TLSDFNJpCV22_kfupsAT1XOuZk4dZb'  # Implementation Drive/Automation/Firewall Rules
 sheet_id = '1OYVd56jFOnsl0nLd3jVAhuo7z9d553llGFkH4lgdNqI'       # Full Solution
 
+# Fields read from each Account Update
+account_update_fields = ['Id', 'Contact_Name__c', 'Contact_Email__c', 
+                         'Install_Date_Time__c', 'IVR_Install_Tier__c', 
+                         'Customer_Account_Google_URL__c', 'Install_Best_Days__c',
+                         'Install_Best_Hours__c', 'Timezone__c', 
+                         'Specific_Install_Hours__c', 'Self_Installing__c',
+                         'Firewall_Rules_Required__c', 'Contact_Phone__c']
+
+# Number of pharmacies worked on at the same time. Set to 1 to
+# process the report one pharmacy at a time.
+max_workers = 8
+
+# Report rows are read and prefetched from SalesForce this many at a time
+prefetch_batch_size = 200
+
+# Account Update changes are saved in batches of this many records
+# (200 at most). Anything left over is saved at the end of each phase.
+update_batch_size = 200
+
+# Keeps one account's output together in the terminal and the log
+output_lock = threading.Lock()
+
+# When the firewall rules come from the spreadsheet every account writes
+# into the same cells and PDF, so only one account at a time
+firewall_lock = threading.Lock()
+
+
+# Fields read from the intake Google Doc
+intake_doc_fields = FieldExtractor({
+    'local_ip_scheme': ('IP Address:', ('Pharmacy', 'Public')),
+    'pms_vendor': 'Pharmacy Software Vendor',
+    'contact_work_number': 'Primary Work Phone',
+    'contact_phone_number': 'Primary Cell Phone',
+    'it_contact_name': 'IT Contact Name',
+    'it_contact_email': 'IT Contact Email'
+})
+
+
+class AccountOutput:
+    """
+    Holds on to everything printed and logged for one account
+    until the account is finished, so that accounts worked on
+    at the same time don't mix their lines together.
+    """
+    def __init__(self, logger) -> None:
+        self.logger = logger
+        self.lines = []
+
+
+    def print(self, message, log=False) -> None:
+        self.lines.append((message, True, log))
+
+
+    def log(self, message) -> None:
+        self.lines.append((message, False, True))
+
+
+    def flush(self) -> None:
+        with output_lock:
+            for message, show, log in self.lines:
+                if show:
+                    print(message)
+                if log:
+                    self.logger.info(message)
+        self.lines = []
 
-def process_google_doc(pharmacy_name):
+
+def process_google_doc(document_text):
     """
-    This function pulls information out of the Google Doc.
+    This function pulls information out of the Google Doc's
+    text (see GoogleDriveAutomation.read_google_doc).
     Reusability is minimal as this information is unique
     to this script's needs.
     """
-    # Set this to the file name that was downloaded
-    filename = pharmacy_name + '.txt'
+    # Scrape the document
+    fields = intake_doc_fields.extract(document_text)
+    local_ip_scheme = fields['local_ip_scheme']
+    pms_vendor = fields['pms_vendor']
+    contact_work_number = fields['contact_work_number'] or ''
+    contact_phone_number = fields['contact_phone_number'] or ''
+    it_contact_name = fields['it_contact_name']
+    it_contact_email = fields['it_contact_email']
 
-    # Initialize the variables
-    local_ip_scheme = None
     opie_ip = "DHCP"
-    pms_vendor = None
-    contact_work_number = None
-    contact_phone_number = None
-    it_contact_name = None
-    it_contact_email = None
-
-    # Scrape the document
-    with open(filename, 'r', encoding='utf-8') as file:
-        for line in file:
-            if 'IP Address:' in line and 'Pharmacy' not in line and 'Public' not in line:
-                local_ip_scheme = line.split(':')[1].strip()
-                try:
-                    split_ip = local_ip_scheme.split('.')
-                    opie_ip = split_ip[0] + '.' + split_ip[1] + '.' + split_ip[2] + '.250'
-                except Exception as e:
-                    pass
-            if 'Pharmacy Software Vendor' in line:
-                pms_vendor = line.split(':')[1].strip()
-            if 'Primary Work Phone' in line:
-                contact_work_number = line.split(':')[1].strip()
-            if 'Primary Cell Phone' in line:
-                contact_phone_number = line.split(':')[1].strip()
-            if 'IT Contact Name' in line:
-                it_contact_name = line.split(':')[1].strip()
-            if 'IT Contact Email' in line:
-                it_contact_email = line.split(':')[1].strip()
-
-    os.remove(filename)
+    if local_ip_scheme:
+        split_ip = local_ip_scheme.split('.')
+        if len(split_ip) >= 3:
+            opie_ip = split_ip[0] + '.' + split_ip[1] + '.' + split_ip[2] + '.250'
 
     if len(contact_phone_number) < 7 and len(contact_work_number) > 5:
         contact_phone_number = contact_work_number
@@ -72,94 +132,67 @@ def process_google_doc(pharmacy_name):
     return opie_ip, pms_vendor, contact_phone_number, it_contact_name, it_contact_email
 
 
-def main():
-    # Set up logging
-    filename = 'fullsolution.log'
-    logger = get_logger(module='main', filename=filename)
-
-    # Load credentials
-    manager = CredentialsManager()
-    success = manager.load_config()
-    if not success:
-        print('Failed to load your configuration file. Stopping the script!')
-        return
-
-    # Authorize access to Google Account
-    google_drive = GoogleDriveAutomation()
-
-    # Verify SalesForce connection
-    obtain_access_token = manager.salesforce_access_token()
-    if not obtain_access_token:
-        print('Failed to get SalesForce access token. Check logs for errors.')
-        return
-
-    logger.info('Script successfully initialized.')
-    print("Script started successfully!")
+def process_account(row, salesforce, google_drive, cal, logger, scheduling) -> list:
+    """
+    Does the work for one row of the report: reads the Account
+    Update and Google Doc, queues the Account Update changes and
+    sends the firewall rules. Pharmacies that need an install are
+    added to scheduling for book_installs.
+    Returns a list of what happened for the run summary.
+    """
+    out = AccountOutput(logger)
+    pharmacy_name = row['Account Name']
+    with log_account(pharmacy_name):
+        try:
+            return _process_account(row, salesforce, google_drive, cal, out, scheduling)
+        finally:
+            out.flush()
+
+
+def _process_account(row, salesforce, google_drive, cal, out, scheduling) -> list:
+    # Grab the useful variables from the report
+    account_update = row['Account Update']
+    pharmacy_name = row['Account Name']
+    ivr_type = row['IVR Type']
+    equipment_arrival_date = row['Equipment Arrival Date']
+    outcomes = []
+
+    # Check if the IVR Type matches the type for the script
+    if ivr_type != project_type:
+        out.print(f'\n{pharmacy_name} is type {ivr_type}. Skipping this pharmacy.')
+        return ['Skipped (wrong IVR type)']
     
-    # Get the report from Salesforce
-    salesforce = SalesForceAutomation()
-    success, reason, report = salesforce.get_report(report_id=report_id)
-    if not success:
-        print(reason)
-        return
+    out.print(f'\nStarting work on {pharmacy_name}.', log=True)
     
-    # This defines the number of rows in the DataFrame
-    rows = report.shape[0]
-
-    # The primary functions of this script are held within this For-Loop
-    for num,row in enumerate(report, start=0):
-        if num >= rows:
-            break
-
-        # Grab the useful variables from the report
-        account_update = report.iloc[num]['Account Update']
-        pharmacy_name = report.iloc[num]['Account Name']
-        ivr_type = report.iloc[num]['IVR Type']
-        equipment_arrival_date = report.iloc[num]['Equipment Arrival Date']
-
-        # Check if the IVR Type matches the type for the script
-        if ivr_type != project_type:
-            print(f'\n{pharmacy_name} is type {ivr_type}. Skipping this pharmacy.')
-            continue
-        
-        print(f'\nStarting work on {pharmacy_name}.')
-        logger.info(f'Starting work on {pharmacy_name}.')
-        
-        # Grab all variables from the Account Update
-        fields = ['Id', 'Contact_Name__c', 'Contact_Email__c', 
-                  'Install_Date_Time__c', 'IVR_Install_Tier__c', 
-                  'Customer_Account_Google_URL__c', 'Install_Best_Days__c',
-                  'Install_Best_Hours__c', 'Timezone__c', 
-                  'Specific_Install_Hours__c', 'Self_Installing__c',
-                  'Firewall_Rules_Required__c', 'Contact_Phone__c']
-        au = salesforce.get_account_update_info(account_update=account_update,
-                                           fields=fields)
-
-        account_update_id = au.get('Id')
-        contact_name = au.get('Contact_Name__c')
-        contact_email = au.get('Contact_Email__c')
-        contact_phone_from_au = au.get('Contact_Phone__c')
-        install_date_time = au.get('Install_Date_Time__c')
-        install_tier = au.get('IVR_Install_Tier__c')
-        install_best_days = au.get('Install_Best_Days__c').split(';')
-        install_best_hours = au.get('Install_Best_Hours__c')
-        install_specific_hours = au.get('Specific_Install_Hours__c')
-        google_url = au.get('Customer_Account_Google_URL__c')
-        full_timezone = au.get('Timezone__c')
-        self_installing = au.get('Self_Installing__c')
-        firewall_rules_required = au.get('Firewall_Rules_Required__c')
-
-        """
-        Time to download the Google Doc. The URL could look like these:
-        https://drive.google.com/drive/folders/g5hqbc9Nk3MwqJbV7
-        https://drive.google.com/drive/folders/g5hqbc9Nk3MwqJbV7?usp=sharing
-        """
-        id_and_extra = google_url.split(sep='/')[5]
-        folder_id = id_and_extra.split('?')[0]
-        success = google_drive.download_google_doc(document_name=pharmacy_name,
-                                                  drive_folder_id=folder_id)
-        if not success:
-            print(f"""
+    # Grab all variables from the Account Update
+    au = salesforce.get_account_update_info(account_update=account_update,
+                                       fields=account_update_fields)
+
+    account_update_id = au.get('Id')
+    contact_name = au.get('Contact_Name__c')
+    contact_email = au.get('Contact_Email__c')
+    contact_phone_from_au = au.get('Contact_Phone__c')
+    install_date_time = au.get('Install_Date_Time__c')
+    install_tier = au.get('IVR_Install_Tier__c')
+    install_best_days = au.get('Install_Best_Days__c').split(';')
+    install_best_hours = au.get('Install_Best_Hours__c')
+    install_specific_hours = au.get('Specific_Install_Hours__c')
+    google_url = au.get('Customer_Account_Google_URL__c')
+    full_timezone = au.get('Timezone__c')
+    self_installing = au.get('Self_Installing__c')
+    firewall_rules_required = au.get('Firewall_Rules_Required__c')
+
+    """
+    Time to download the Google Doc. The URL could look like these:
+    https://drive.google.com/drive/folders/g5hqbc9Nk3MwqJbV7
+    https://drive.google.com/drive/folders/g5hqbc9Nk3MwqJbV7?usp=sharing
+    """
+    id_and_extra = google_url.split(sep='/')[5]
+    folder_id = id_and_extra.split('?')[0]
+    document_text = google_drive.read_google_doc(document_name=pharmacy_name,
+                                                 drive_folder_id=folder_id)
+    if document_text is None:
+        out.print(f"""
 *******************************************************
  Did not find a Google Doc named, "{pharmacy_name}".
 *******************************************************
@@ -170,192 +203,472 @@ def main():
 
 Skipping {pharmacy_name} for now and processing the next one.
 """)
+        return ['Missing Google Doc']
+
+    (opie_ip, 
+    pms_vendor, 
+    contact_phone_number, 
+    it_contact_name,
+    it_contact_email) = process_google_doc(document_text=document_text)
+
+    if not contact_phone_number:
+        contact_phone_number = contact_phone_from_au
+
+    # Determine if the pharmacy already has an install date
+    if install_date_time:
+        out.print('    O Install is already scheduled', log=True)
+        payload = {'Status__c': 'Install Requested'}
+        salesforce.queue_account_update(account_update_id=account_update_id, 
+                                        payload=payload)
+        outcomes.append('Install already scheduled')
+
+    # Else schedule install. Slots are picked for every pharmacy of
+    # the run together once all accounts are done (see book_installs).
+    else:
+        out.print('    O Must schedule install', log=True)
+
+        # Determine install tier
+        if install_tier == "Tier 3":
+            event_id = 740786
+            out.log('    O Install tier 3')
+        elif install_tier == "Tier 2" and not firewall_rules_required:
+            event_id = 740772
+            out.log('    O Install tier 2')
+        else:
+            event_id = 740750
+            out.log('    O Install tier 1')
+        
+        # Convert TimeZone (e.g. "Eastern Standard Time" to "US/Eastern")
+        timezone = cal.convert_timezone(timezone=full_timezone)
+
+        # Convert days ("Monday", "Wednesday", etc.) to 
+        # dates between this week and next            
+        install_best_dates = cal.convert_days_to_dates(preferred_days=install_best_days)
+        
+        # Either First Available or specified hours
+        install_best_times = None
+        if install_best_hours != 'First Available':
+            specific_hours = None
+            if install_specific_hours:
+                specific_hours = install_specific_hours.split(',')
+            
+            install_best_times = cal.convert_hours_to_time(preferred_hours=install_best_hours, 
+                                                           specific_hours=specific_hours) or []
+
+        if not timezone:
+            out.print(f'    X Unknown timezone "{full_timezone}". Skipped scheduling the install')
+            outcomes.append('Scheduling failed')
+        else:
+            scheduling.append({'key': account_update_id,
+                               'event_id': event_id,
+                               'timezone': timezone,
+                               'start_date': equipment_arrival_date,
+                               'preferred_dates': install_best_dates,
+                               'preferred_times': install_best_times,
+                               'pharmacy_name': pharmacy_name,
+                               'contact_name': contact_name,
+                               'contact_email': contact_email,
+                               'contact_phone': contact_phone_number,
+                               'template_logic': {'ivr_type': ivr_type, 'self install': self_installing}})
+
+    # Send Firewall Rules
+    if not firewall_rules_required:
+        return outcomes
+
+    out.print('    O Must send firewall rules')
+
+    # Get Opie MAC Address
+    error, opie_info = salesforce.get_asset_info(account_update=account_update,
+                                                 asset_name='Opie',
+                                                 fields=['MAC_Address__c'])
+    if error:
+        opie_mac_address = "None" # The MAC is not necessary for FW Rules
+        out.print(error) 
+    else:
+        opie_mac_address = opie_info.get('MAC_Address__c')
+
+    # Get PBX Hostname
+    error, pbx_info = salesforce.get_asset_info(account_update=account_update,
+                                                 asset_name='PBX',
+                                                 fields=['Vow_Asset_URL__c'])
+    if error:
+        out.print(error) # Hostname is necessary for FW Rules
+        out.print('    X Skipped sending firewall rules')
+        return outcomes + ['Firewall rules failed']
+
+    pbx_hostname = hostname_from_url(pbx_info.get('Vow_Asset_URL__c'))
+
+    # The PDF is made locally. Only when the template has formulas
+    # that can't be worked out here does it come from the shared
+    # spreadsheet, one account at a time.
+    pbx_ip_address, error = get_resolver().resolve(pbx_hostname)
+    if error:
+        out.print(error)
+        return outcomes + ['Firewall rules failed']
+
+    attachment, error = google_drive.firewall_rules_pdf(sheet_id=sheet_id,
+                                                        pbx_hostname=pbx_hostname,
+                                                        pbx_ip_address=pbx_ip_address,
+                                                        opie_mac_address=opie_mac_address,
+                                                        opie_ip_address=opie_ip,
+                                                        pms_vendor=pms_vendor)
+    if isinstance(error, FirewallRulesError):
+        out.print(f'    O {error.reason} Using the spreadsheet instead', log=True)
+        attachment, error = firewall_rules_from_sheet(google_drive=google_drive,
+                                                      pbx_hostname=pbx_hostname,
+                                                      pbx_ip_address=pbx_ip_address,
+                                                      opie_mac_address=opie_mac_address,
+                                                      opie_ip_address=opie_ip,
+                                                      pms_vendor=pms_vendor)
+    if error:
+        out.print(error)
+        return outcomes + ['Firewall rules failed']
+
+    # Email Firewall Rules to Contact, IT Contact, and go-live team
+    subject = f'Phone system firewall rules to implement - {pharmacy_name} - [Installation]'
+    recipients = [contact_email, it_contact_email, 'ivr.golive@lumistry.com']
+    body = """Hello,<br><br>
+Please review the attached firewall rules and implement them prior to the installation session.<br><br>
+
+A DHCP pool is required for our phones and integration device. The phones will remain DHCP, but we would like to statically assign the On-Premise Interface Equipment (OPIE). 
+Typically, the address at .250 is available on the network. We will statically assign the OPIE to .250 unless you have a conflict.<br><br>
+
+If you have any questions, please reply to this email or call us at (864) 541-0650 and ask for the Installation Team.<br><br>
+"""
+    # Sent with other accounts' emails in one batch, see send_firewall_emails
+    success, error = google_drive.queue_email_with_attachement(key=(account_update, pharmacy_name),
+                                                               receiver_emails=recipients,
+                                                               subject=subject,
+                                                               body=body,
+                                                               attachment=attachment,
+                                                               attachment_name='Firewall Rules.pdf')
+    if not success:
+        out.print('    X Failed sending email with firewall rules')
+        out.print(error)
+        return outcomes + ['Firewall rules failed']
+    
+    out.print('    O Queued firewall rules email')
+
+    return outcomes
+
+
+def firewall_rules_from_sheet(google_drive, pbx_hostname, pbx_ip_address, opie_mac_address, opie_ip_address, pms_vendor):
+    """
+    Fills in the shared spreadsheet and exports it, for templates
+    firewall_rules_pdf can't handle. Returns the PDF's bytes and
+    an error.
+    """
+    with firewall_lock:
+        success, error = google_drive.firewall_rules_spreadsheet(folder_id=firewall_rules_folder_id,
+                                                                sheet_id=sheet_id,
+                                                                pbx_hostname=pbx_hostname,
+                                                                pbx_ip_address=pbx_ip_address,
+                                                                opie_mac_address=opie_mac_address,
+                                                                opie_ip_address=opie_ip_address,
+                                                                pms_vendor=pms_vendor)
+        if not success:
+            return None, error
+
+        success, error = google_drive.download_google_sheet(sheet_id=sheet_id,
+                                                            destination_file='Firewall Rules.pdf')
+        if not success:
+            return None, error
+
+        with open('Firewall Rules.pdf', 'rb') as file:
+            attachment = file.read()
+        os.remove('Firewall Rules.pdf')
+        return attachment, None
+
+
+def prefetch(salesforce, rows) -> None:
+    """
+    Loads the Account Updates for a page of report rows, plus the
+    Opie and PBX Assets of every account that needs firewall rules,
+    and starts looking up the PBX hostnames.
+    """
+    names = [row['Account Update'] for row in rows]
+    salesforce.prefetch_account_updates(account_updates=names,
+                                        fields=account_update_fields)
+
+    index = salesforce.account_update_index['by_name']
+    firewall_accounts = [name for name in names
+                         if index.get(name, {}).get('Firewall_Rules_Required__c')]
+    if firewall_accounts:
+        salesforce.prefetch_assets(account_updates=firewall_accounts,
+                                   asset_names=['Opie', 'PBX'],
+                                   fields=['MAC_Address__c', 'Vow_Asset_URL__c'])
+
+        pbx_assets = (salesforce.asset_index.get((name, 'PBX')) for name in firewall_accounts)
+        get_resolver().prefetch(hostname_from_url(asset.get('Vow_Asset_URL__c'))
+                                for asset in pbx_assets if asset)
+
+
+def hostname_from_url(url) -> str:
+    # 'https://pbx.example.com/admin' -> 'pbx.example.com'
+    return (url or '').split('//')[-1].split('/')[0]
+
+
+def collect_result(future, pharmacy_name, logger, summary) -> None:
+    # Adds one finished account (a list of outcomes, or one outcome) to the run summary
+    try:
+        result = future.result()
+        summary.update([result] if isinstance(result, str) else result)
+    except Exception:
+        logger.exception(f'Unexpected error while working on {pharmacy_name}')
+        with output_lock:
+            print(f'\n    X Unexpected error while working on {pharmacy_name}. See logs')
+        summary['Unexpected error'] += 1
+
+
+def send_firewall_emails(google_drive, logger, summary) -> None:
+    # Sends the firewall rules emails still queued and reports the ones that failed
+    for (account_update, pharmacy_name), (success, error) in google_drive.flush_emails().items():
+        if success:
+            summary['Firewall rules sent'] += 1
             continue
+        logger.error(f'Failed sending firewall rules for {account_update}: {error}')
+        print(f'\n{pharmacy_name}:\n    X Failed sending email with firewall rules\n    {error}')
+        summary['Firewall rules failed'] += 1
+
+
+def book_installs(cal, salesforce, scheduling, logger, summary) -> list:
+    """
+    Picks a slot for every pharmacy in scheduling at once with
+    CalCom.assign_slots, then books them several at a time.
+    Returns the confirmations for send_confirmations.
+    """
+    assignments = cal.assign_slots(install_requests=scheduling)
+    confirmations = []
 
-        (opie_ip, 
-        pms_vendor, 
-        contact_phone_number, 
-        it_contact_name,
-        it_contact_email) = process_google_doc(pharmacy_name=pharmacy_name)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for request in scheduling:
+            future = pool.submit(book_install, request, assignments.get(request['key']),
+                                 cal, salesforce, logger, confirmations)
+            futures[future] = request['pharmacy_name']
 
-        if not contact_phone_number:
-            contact_phone_number = contact_phone_from_au
+        for future in as_completed(futures):
+            collect_result(future, futures[future], logger, summary)
 
-        # Determine if the pharmacy already has an install date
-        if install_date_time:
-            print('    O Install is already scheduled')
-            logger.info('    O Install is already scheduled')
-            payload = {'Status__c': 'Install Requested'}
-            salesforce.update_account_update(account_update_id=account_update_id, 
-                                             payload=payload)
+    return confirmations
 
-        # Else schedule install
+
+def book_install(request, assignment, cal, salesforce, logger, confirmations) -> str:
+    """
+    Books the slot assign_slots picked for one pharmacy and queues
+    the Account Update changes. Returns what happened for the run
+    summary.
+    """
+    out = AccountOutput(logger)
+    pharmacy_name = request['pharmacy_name']
+    with log_account(pharmacy_name):
+        out.print(f'\n{pharmacy_name}:')
+        try:
+            return _book_install(request, assignment, cal, salesforce, out, confirmations)
+        finally:
+            out.flush()
+
+
+def _book_install(request, assignment, cal, salesforce, out, confirmations) -> str:
+    account_update_id = request['key']
+    timezone = request['timezone']
+    if not assignment:
+        out.print('    X No available times in the next week for this pharmacy. ')
+        return 'No install slots available'
+
+    result, slot = assignment
+    result_mapping = {
+        'Perfect Match': '    O There is an available slot that is a perfect match',
+        'Close Enough': '    O Their preferred day is available, but had to compromise on time',
+        'Nothing': f'    X Found no matching slot. Forced this slot: {slot}',
+        'First Available': f'    O Booking the first available slot: {slot}'
+    }
+    out.print(result_mapping[result])
+    event_slot = cal.combine_day_time(day_time=slot, timezone=timezone)
+
+    # Book the appointment
+    success, reschedule_link = cal.schedule_install(event_id=request['event_id'], 
+                                                event_slot=event_slot,
+                                                pharmacy_name=request['pharmacy_name'], 
+                                                customer_name=request['contact_name'],
+                                                customer_email=request['contact_email'], 
+                                                customer_phone=request['contact_phone'],
+                                                timezone=timezone)
+    if not success:
+        out.print('    X Ran into an issue with scheduling this pharmacy. See logs')
+        return 'Scheduling failed'
+        
+    # Amend the Account Update
+    customers_datetime = salesforce.prepare_install_date(event_slot=event_slot)
+    payload = {'Install_Date_Time__c': customers_datetime, 
+                'Status__c': 'Install Requested',
+                'Contact_Phone__c': request['contact_phone'],
+                'Reschedule_Install_Appointment__c': reschedule_link}
+    
+    salesforce.queue_account_update(account_update_id=account_update_id, payload=payload)
+    out.print('    O Scheduled install')
+    confirmations.append({'pharmacy_name': request['pharmacy_name'],
+                          'account_update_id': account_update_id,
+                          'template_logic': request['template_logic'],
+                          'event_slot': event_slot})
+    return 'Install scheduled'
+
+
+def flush_account_updates(salesforce, confirmed, summary) -> None:
+    # Saves the Account Update changes still queued and reports every save that failed and wasn't reported already
+    final_results = salesforce.flush_account_updates()
+    for account_update_id, (success, errors) in salesforce.update_results.items():
+        if success or (account_update_id in confirmed and account_update_id not in final_results):
+            continue
         else:
-            print('    O Must schedule install')
-            logger.info('    O Must schedule install')
-            
-            # Initialize Cal.com portion
-            cal = CalCom()
-
-            # Determine install tier
-            if install_tier == "Tier 3":
-                event_id = 740786
-                logger.info('    O Install tier 3')
-            elif install_tier == "Tier 2" and not firewall_rules_required:
-                event_id = 740772
-                logger.info('    O Install tier 2')
-            else:
-                event_id = 740750
-                logger.info('    O Install tier 1')
-            
-            # Convert TimeZone (e.g. "Eastern Standard Time" to "US/Eastern")
-            timezone = cal.convert_timezone(timezone=full_timezone)
+            print(f'    X Failed to update Account Update {account_update_id}: {errors}')
+            summary['Account Update failed'] += 1
 
-            available_slots = cal.get_event_slots(event_id=event_id, 
-                                                  start_date=equipment_arrival_date, 
-                                                  timezone=timezone)
 
-            # Convert days ("Monday", "Wednesday", etc.) to 
-            # dates between this week and next            
-            install_best_dates = cal.convert_days_to_dates(preferred_days=install_best_days)
-            
-            # This is not how I imagined this to work. Needs updating!
-            # Picking the Event Slot: Either First Available ...
-            if install_best_hours == 'First Available':
-                slot = cal.get_first_available(avail_slots=available_slots)
-                if slot == None:
-                    print('    X No available times in the next week for this pharmacy. ')
-                    continue
-                event_slot = cal.combine_day_time(day_time=slot, timezone=timezone)
-                
-            # or specified hours
-            else:
-                specific_hours = None
-                if install_specific_hours:
-                    specific_hours = install_specific_hours.split(',')
-                
-                install_best_times = cal.convert_hours_to_time(preferred_hours=install_best_hours, 
-                                                               specific_hours=specific_hours)
-
-                result, slot = cal.compare_pref_to_available(preferred_dates=install_best_dates, 
-                                                             preferred_times=install_best_times, 
-                                                             available_slots=available_slots)
-
-                result_mapping = {
-                    'Perfect Match': '    O There is an available slot that is a perfect match',
-                    'Close Enough': '    O Their preferred day is available, but had to compromise on time',
-                    'Nothing': f'    X Found no matching slot. Forced this slot: {slot}'
-                }
-
-                print(result_mapping[result])
-
-                event_slot = cal.combine_day_time(day_time=slot, timezone=timezone)
-
-            # Book the appointment
-            success, reschedule_link = cal.schedule_install(event_id=event_id, 
-                                                        event_slot=event_slot,
-                                                        pharmacy_name=pharmacy_name, 
-                                                        customer_name=contact_name,
-                                                        customer_email=contact_email, 
-                                                        customer_phone=contact_phone_number,
-                                                        timezone=timezone)
-            if not success:
-                print('    X Ran into an issue with scheduling this pharmacy. See logs')
-                
-            # Amend the Account Update
-            else:
-                customers_datetime = salesforce.prepare_install_date(event_slot=event_slot)
-                payload = {'Install_Date_Time__c': customers_datetime, 
-                            'Status__c': 'Install Requested',
-                            'Contact_Phone__c': contact_phone_number,
-                            'Reschedule_Install_Appointment__c': reschedule_link}
-                
-                salesforce.update_account_update(account_update_id=account_update_id, payload=payload)
-                print('    O Scheduled install and updated Account Update successfully')
-                
-                contact_id = salesforce.get_contact_id(account_update_id=account_update_id)
-                template_logic = {'ivr_type': ivr_type, 'self install': self_installing}
-                success = salesforce.send_email_with_template(template_logic=template_logic,
-                                                    contact_id=contact_id,
-                                                    account_update_id=account_update_id)
-                if not success:
-                    print('    X Failed to send appointment confirmation from Account Update')
-                else:
-                    print('    O Sent appointment confirmation email from Account Update')
-
-                payload = {'Install_Date_Time__c': event_slot}
-                salesforce.update_account_update(account_update_id=account_update_id, 
-                                                 payload=payload)
-
-        # Send Firewall Rules
-        if not firewall_rules_required:
+def send_confirmations(salesforce, confirmations, logger, summary) -> None:
+    """
+    Runs after the scheduling updates have been flushed. Emails the
+    appointment confirmation for every Account Update that saved,
+    all through a few flow calls, then queues the final
+    Install_Date_Time__c rewrite.
+    """
+    outputs = {}
+    for confirmation in confirmations:
+        account_update_id = confirmation['account_update_id']
+        out = AccountOutput(logger)
+        out.print(f'\n{confirmation["pharmacy_name"]}:')
+
+        success, errors = salesforce.update_results.get(account_update_id, (False, ['Never sent']))
+        if not success:
+            out.print(f'    X Failed to update Account Update: {errors}', log=True)
+            summary['Account Update failed'] += 1
+            out.flush()
+            continue
+        out.print('    O Updated Account Update successfully')
+
+        contact_id = salesforce.get_contact_id(account_update_id=account_update_id)
+        salesforce.queue_email_with_template(template_logic=confirmation['template_logic'],
+                                             contact_id=contact_id,
+                                             account_update_id=account_update_id)
+        outputs[account_update_id] = out
+
+    email_results = salesforce.flush_emails_with_template()
+
+    for confirmation in confirmations:
+        account_update_id = confirmation['account_update_id']
+        out = outputs.get(account_update_id)
+        if out is None:
             continue
 
+        success, errors = email_results.get(account_update_id, (False, ['Never sent']))
+        if not success:
+            out.print('    X Failed to send appointment confirmation from Account Update')
+            summary['Confirmation email failed'] += 1
         else:
-            print('    O Must send firewall rules')
-
-            # Get Opie MAC Address
-            error, opie_info = salesforce.get_asset_info(account_update=account_update,
-                                                         asset_name='Opie',
-                                                         fields=['MAC_Address__c'])
-            if error:
-                opie_mac_address = "None" # The MAC is not necessary for FW Rules
-                print(error) 
-            else:
-                opie_mac_address = opie_info.get('MAC_Address__c')
-
-            # Get PBX Hostname
-            error, pbx_info = salesforce.get_asset_info(account_update=account_update,
-                                                         asset_name='PBX',
-                                                         fields=['Vow_Asset_URL__c'])
-            if error:
-                print(error) # Hostname is necessary for FW Rules
-                print('    X Skipped sending firewall rules')
-                continue
-
-            else:
-                full_url = pbx_info.get('Vow_Asset_URL__c')
-                pbx_hostname = full_url.split('//')[1].split('/')[0]
-            
-            success, error = google_drive.firewall_rules_spreadsheet(folder_id=firewall_rules_folder_id,
-                                                                    sheet_id=sheet_id,
-                                                                    pbx_hostname=pbx_hostname,
-                                                                    opie_mac_address=opie_mac_address,
-                                                                    opie_ip_address=opie_ip,
-                                                                    pms_vendor=pms_vendor)
-            if not success:
-                print(error)
-                continue
-            
-            success, error = google_drive.download_google_sheet(sheet_id=sheet_id,
-                                                                destination_file='Firewall Rules.pdf')
-            if not success:
-                print(error)
-                continue
-            
-            # Email Firewall Rules to Contact, IT Contact, and go-live team
-            subject = f'Phone system firewall rules to implement - {pharmacy_name} - [Installation]'
-            recipients = [contact_email, it_contact_email, 'ivr.golive@lumistry.com']
-            body = """Hello,<br><br>
-Please review the attached firewall rules and implement them prior to the installation session.<br><br>
+            out.print('    O Sent appointment confirmation email from Account Update')
+            summary['Confirmation email sent'] += 1
 
-A DHCP pool is required for our phones and integration device. The phones will remain DHCP, but we would like to statically assign the On-Premise Interface Equipment (OPIE). 
-Typically, the address at .250 is available on the network. We will statically assign the OPIE to .250 unless you have a conflict.<br><br>
+        payload = {'Install_Date_Time__c': confirmation['event_slot']}
+        salesforce.queue_account_update(account_update_id=account_update_id, 
+                                        payload=payload)
+        out.flush()
 
-If you have any questions, please reply to this email or call us at (864) 541-0650 and ask for the Installation Team.<br><br>
-"""
-            success, error = google_drive.email_with_attachement(receiver_emails=recipients,
-                                                                 subject=subject,
-                                                                 body=body,
-                                                                 attachment_path='Firewall Rules.pdf')
-            if not success:
-                print('    X Failed sending email with firewall rules')
-                print(error)
-                continue
-            
-            print('    O Sent firewall rules successfully')
 
-            os.remove('Firewall Rules.pdf')
+def main():
+    # Set up logging
+    filename = 'fullsolution.log'
+    logger = get_logger(module='main', filename=filename)
+
+    # Load credentials
+    manager = CredentialsManager()
+    success = manager.load_config()
+    if not success:
+        print('Failed to load your configuration file. Stopping the script!')
+        return
+
+    # Google Account access is set up the first time it is needed
+    google_drive = GoogleDriveAutomation()
+
+    # Verify SalesForce connection
+    obtain_access_token = manager.salesforce_access_token()
+    if not obtain_access_token:
+        print('Failed to get SalesForce access token. Check logs for errors.')
+        return
+
+    logger.info('Script successfully initialized.')
+    print("Script started successfully!")
+    
+    # Get the report from Salesforce. Rows are worked on as they
+    # arrive, a page of prefetch_batch_size rows at a time.
+    salesforce = SalesForceAutomation(flush_updates_at=update_batch_size,
+                                      token_provider=manager.token_provider)
+    cal = CalCom()
+    rows = salesforce.iter_report_rows(report_id=report_id,
+                                       query=report_query,
+                                       column_labels=report_columns,
+                                       bulk_threshold=bulk_threshold)
+
+    # The primary functions of this script happen in process_account,
+    # several pharmacies at a time
+    summary = Counter()
+    scheduling = []
+    row_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        try:
+            for batch in chunks(rows, prefetch_batch_size):
+                # Leaves enough of the day's SalesForce API calls to finish what's started
+                check_api_budget()
+                row_count += len(batch)
+                prefetch(salesforce, batch)
+                for row in batch:
+                    future = pool.submit(process_account, row, salesforce, google_drive, cal, logger, scheduling)
+                    futures[future] = row['Account Name']
+
+                # Don't read further ahead than the workers can keep up with
+                while len(futures) > max_workers * 4:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect_result(future, futures.pop(future), logger, summary)
+
+        except ReportError as error:
+            print(error.reason)
+            if not row_count:
+                return
+
+        except BudgetExceeded as error:
+            print(f'\n{error.reason}')
+            logger.warning(error.reason)
+            if not row_count:
+                return
+
+        for future in as_completed(futures):
+            collect_result(future, futures[future], logger, summary)
+
+    if not row_count:
+        print('The report is empty!')
+        return
+
+    # Account Update changes reported by send_confirmations already
+    confirmed = set()
+    try:
+        send_firewall_emails(google_drive, logger, summary)
+
+        # Book every install together, save the changes, then send the confirmations
+        confirmations = book_installs(cal, salesforce, scheduling, logger, summary)
+        salesforce.flush_account_updates()
+        send_confirmations(salesforce, confirmations, logger, summary)
+        confirmed = {confirmation['account_update_id'] for confirmation in confirmations}
+    finally:
+        # The queued changes are saved even if a step above failed,
+        # so accounts already worked on don't lose their status
+        flush_account_updates(salesforce, confirmed, summary)
+
+    print('\nSummary:')
+    logger.info('Summary:')
+    for outcome, count in sorted(summary.items()):
+        print(f'    {outcome}: {count}')
+        logger.info(f'    {outcome}: {count}')
 
     input('The script is done. Press ENTER to close this window.')
 